@@ -0,0 +1,334 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+import numpy as np
+
+from questionnaire import questionnaire_index, registry
+from scoring import ScoringEngine
+
+# Default number of respondents scored per chunk; bounds memory for large files
+DEFAULT_CHUNK_SIZE = 10000
+
+# Column holding the respondent identifier in input and output files
+DEFAULT_ID_COLUMN = "respondent_id"
+
+FORMATS = ("csv", "jsonl", "parquet")
+
+
+# Function to guess a file format from its extension
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    if extension in ("ndjson", "json"):
+        return "jsonl"
+    if extension == "pq":
+        return "parquet"
+    if extension not in FORMATS:
+        raise ValueError(f"Cannot infer file format from {path!r}; use one of {', '.join(FORMATS)}")
+    return extension
+
+
+# Function to import pyarrow only when Parquet is actually used
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise RuntimeError("Parquet support requires the 'pyarrow' package") from e
+    return pyarrow
+
+
+# Functions to stream an input file as columnar chunks: (ids, {question: values}, num_rows)
+# Rows may leave keys out: a missing question is unanswered and a missing id falls
+# back to the row's position in the file.
+def _rows_to_chunk(rows, id_column, start):
+    columns = {}
+    for i, row in enumerate(rows):
+        for key, value in row.items():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = [None] * len(rows)
+            column[i] = value
+    ids = columns.pop(id_column, None)
+    if ids is None:
+        ids = list(range(start, start + len(rows)))
+    else:
+        ids = [start + i if respondent_id is None else respondent_id for i, respondent_id in enumerate(ids)]
+    return ids, columns, len(rows)
+
+
+def _read_csv_chunks(path, chunk_size, id_column):
+    # utf-8-sig drops the byte order mark that Excel puts at the start of CSV exports
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        start = 0
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                break
+            if any(len(row) != len(header) for row in rows):
+                raise ValueError(f"Rows {start}-{start + len(rows)} of {path!r} do not match the header")
+            columns = dict(zip(header, zip(*rows)))
+            ids = columns.pop(id_column, None) or list(range(start, start + len(rows)))
+            yield list(ids), columns, len(rows)
+            start += len(rows)
+
+
+def _read_jsonl_chunks(path, chunk_size, id_column):
+    with open(path, encoding="utf-8") as f:
+        lines = ((number, line) for number, line in enumerate(f, 1) if line.strip())
+        start = 0
+        while True:
+            rows = []
+            for number, line in islice(lines, chunk_size):
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError(f"Line {number} of {path!r} is not a JSON object")
+                rows.append(row)
+            if not rows:
+                break
+            yield _rows_to_chunk(rows, id_column, start)
+            start += len(rows)
+
+
+def _read_parquet_chunks(path, chunk_size, id_column):
+    pyarrow = _require_pyarrow()
+    parquet_file = pyarrow.parquet.ParquetFile(path)
+    start = 0
+    for record_batch in parquet_file.iter_batches(batch_size=chunk_size):
+        columns = {}
+        ids = None
+        for name, column in zip(record_batch.schema.names, record_batch.columns):
+            if name == id_column:
+                ids = column.to_pylist()
+            elif pyarrow.types.is_integer(column.type) and column.null_count == 0:
+                columns[name] = column.to_numpy()
+            else:
+                columns[name] = column.to_pylist()
+        num_rows = record_batch.num_rows
+        if ids is None:
+            ids = list(range(start, start + num_rows))
+        yield ids, columns, num_rows
+        start += num_rows
+
+
+_READERS = {
+    "csv": _read_csv_chunks,
+    "jsonl": _read_jsonl_chunks,
+    "parquet": _read_parquet_chunks,
+}
+
+
+# Function to stream encoded chunks from a response file.
+# Yields (ids, answers matrix) pairs of at most chunk_size respondents each.
+def iter_encoded_chunks(path, engine=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                        input_format=None, id_column=DEFAULT_ID_COLUMN):
+    engine = engine or default_engine()
+    reader = _READERS[input_format or detect_format(path)]
+    for ids, columns, num_rows in reader(path, chunk_size, id_column):
+        yield ids, engine.encode_columns(columns, num_rows)
+
+
+# Function to stream encoded chunks together with one extra, non-question column
+# (such as a team). Yields (ids, column values as strings, answers matrix) triples.
+def iter_labelled_chunks(path, label_column, engine=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                         input_format=None, id_column=DEFAULT_ID_COLUMN):
+    engine = engine or default_engine()
+    reader = _READERS[input_format or detect_format(path)]
+    for ids, columns, num_rows in reader(path, chunk_size, id_column):
+        labels = columns.pop(label_column, None)
+        if labels is None:
+            raise ValueError(f"{path!r} has no {label_column!r} column")
+        yield ids, [str(label) for label in labels], engine.encode_columns(columns, num_rows)
+
+
+# Function to stream scored chunks from a response file.
+# Yields (ids, ScoreResult) pairs of at most chunk_size respondents each.
+def iter_scored_chunks(path, engine=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                       input_format=None, id_column=DEFAULT_ID_COLUMN):
+    engine = engine or default_engine()
+    for ids, matrix in iter_encoded_chunks(path, engine, chunk_size, input_format, id_column):
+        yield ids, engine.score(matrix)
+
+
+# Function to list the output columns for per-respondent results
+def result_columns(engine, id_column=DEFAULT_ID_COLUMN):
+    columns = [id_column, "Total Score", "Total Percentage"]
+    for category_name in engine.category_names:
+        columns += [f"{category_name} Score", f"{category_name} Percentage"]
+    for category_name, type_name in engine.groups:
+        columns += [f"{category_name} - {type_name} Score", f"{category_name} - {type_name} Percentage"]
+    return columns
+
+
+# Function to lay out one scored chunk as rows matching result_columns()
+def result_rows(ids, result):
+    engine = result.engine
+    scores = np.column_stack([result.totals, result.per_category, result.per_group])
+    percentages = np.column_stack([
+        result.totals / engine.max_total_score * 100,
+        result.category_percentages,
+        result.group_percentages,
+    ]).round(2)
+    for respondent_id, row_scores, row_percentages in zip(ids, scores.tolist(), percentages.tolist()):
+        row = [respondent_id]
+        for score, percentage in zip(row_scores, row_percentages):
+            row += [score, percentage]
+        yield row
+
+
+# Writers append chunks of result rows to the output file
+class _CsvWriter:
+    def __init__(self, path, columns):
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class _JsonlWriter:
+    def __init__(self, path, columns):
+        self.file = open(path, "w", encoding="utf-8")
+        self.columns = columns
+
+    def write(self, rows):
+        for row in rows:
+            self.file.write(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class _ParquetWriter:
+    def __init__(self, path, columns):
+        self.pyarrow = _require_pyarrow()
+        self.path = path
+        self.columns = columns
+        self.writer = None
+
+    def write(self, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        table = self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array(values) for values in zip(*rows)], names=self.columns
+        )
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+_WRITERS = {
+    "csv": _CsvWriter,
+    "jsonl": _JsonlWriter,
+    "parquet": _ParquetWriter,
+}
+
+
+# Function to score a whole response file and write per-respondent results.
+# Only one chunk is held in memory at a time. Returns the number of respondents.
+def score_file(input_path, output_path, engine=None, chunk_size=DEFAULT_CHUNK_SIZE,
+               input_format=None, output_format=None, id_column=DEFAULT_ID_COLUMN,
+               progress=None):
+    engine = engine or default_engine()
+    writer = _WRITERS[output_format or detect_format(output_path)](
+        output_path, result_columns(engine, id_column)
+    )
+    count = 0
+    try:
+        for ids, result in iter_scored_chunks(input_path, engine, chunk_size, input_format, id_column):
+            writer.write(result_rows(ids, result))
+            count += len(result)
+            if progress:
+                progress(count)
+    finally:
+        writer.close()
+    return count
+
+
+_default_engine = None
+_engines = {}
+
+
+# Function to get the scoring engine for the default questionnaire
+def default_engine():
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = ScoringEngine(questionnaire_index)
+    return _default_engine
+
+
+# Function to get the scoring engine of a questionnaire version ("name" or
+# "name@version"), or of the default questionnaire when key is None
+def engine_for(key=None):
+    if key is None:
+        return default_engine()
+    key = registry.resolve(key)
+    engine = _engines.get(key)
+    if engine is None:
+        engine = _engines[key] = ScoringEngine(registry.get(key))
+    return engine
+
+
+# Function to add the --questionnaire option shared by the command line tools
+def add_questionnaire_argument(parser):
+    parser.add_argument(
+        "--questionnaire",
+        help="Questionnaire version as name or name@version (default: BIAS_QUESTIONNAIRE, else the latest anti-bias)",
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Score completed anti-bias self assessments in bulk."
+    )
+    parser.add_argument("input", help="CSV, JSONL or Parquet file with one column per question")
+    parser.add_argument("output", help="CSV, JSONL or Parquet file for per-respondent results")
+    parser.add_argument("--input-format", choices=FORMATS)
+    parser.add_argument("--output-format", choices=FORMATS)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--id-column", default=DEFAULT_ID_COLUMN)
+    add_questionnaire_argument(parser)
+    parser.add_argument("--quiet", action="store_true", help="Do not report progress")
+    args = parser.parse_args(argv)
+
+    def report(count):
+        print(f"Scored {count} respondents", file=sys.stderr)
+
+    started = time.perf_counter()
+    try:
+        count = score_file(
+            args.input, args.output,
+            engine=engine_for(args.questionnaire),
+            chunk_size=args.chunk_size,
+            input_format=args.input_format,
+            output_format=args.output_format,
+            id_column=args.id_column,
+            progress=None if args.quiet else report,
+        )
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    if not args.quiet:
+        print(f"Done: {count} respondents in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,371 @@
+import argparse
+import cProfile
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import batch
+from questionnaire import MAX_SCORE_PER_QUESTION
+
+# Respondent counts used by the scaling stages unless --sizes is given
+DEFAULT_SIZES = (1, 1000, 100000)
+
+# Slowdown (or growth in output bytes) over the baseline that counts as a regression
+DEFAULT_THRESHOLD = 0.25
+
+
+# Function to generate a synthetic (respondents x questions) answer matrix.
+# missing_rate is the share of unanswered questions (coded 0).
+def synthetic_answers(n, engine=None, seed=0, missing_rate=0.0):
+    engine = engine or batch.default_engine()
+    rng = np.random.default_rng(seed)
+    answers = rng.integers(1, MAX_SCORE_PER_QUESTION + 1, size=(n, engine.num_questions), dtype=np.int16)
+    if missing_rate:
+        answers[rng.random(answers.shape) < missing_rate] = 0
+    return answers
+
+
+# Function to turn answer rows into the list-of-dicts responses the app used to build
+def synthetic_responses(answers, engine=None):
+    engine = engine or batch.default_engine()
+    return [
+        [
+            {"category": q.category, "type": q.type, "question": q.text, "score": int(row[q.id]) or None}
+            for q in engine.index.questions
+        ]
+        for row in answers
+    ]
+
+
+# Stages. Each one prepares its input outside the timed region and returns a
+# function that does the measured work and returns the bytes it produced (or 0).
+
+def stage_total_scores_per_category(n):
+    engine = batch.default_engine()
+    responses = synthetic_responses(synthetic_answers(n, engine), engine)
+
+    def run():
+        for person in responses:
+            engine.score(engine.encode(person)).category_totals()
+        return 0
+    return run
+
+
+def stage_score_matrix(n):
+    engine = batch.default_engine()
+    answers = synthetic_answers(n, engine)
+
+    def run():
+        result = engine.score(answers)
+        result.category_percentages, result.group_percentages
+        return 0
+    return run
+
+
+def stage_type_aggregation(n):
+    import report
+    engine = batch.default_engine()
+    result = engine.score(synthetic_answers(n, engine))
+
+    def run():
+        for i in range(len(result)):
+            report.scores_frame(result.type_rows(i))
+        return 0
+    return run
+
+
+def stage_cohort_stats(n):
+    import cohort
+    engine = batch.default_engine()
+    answers = synthetic_answers(n, engine)
+
+    def run():
+        stats = cohort.CohortStats(engine)
+        stats.add_batch(answers)
+        stats.category_summary()
+        return 0
+    return run
+
+
+def _report_inputs(n):
+    import report
+    engine = batch.default_engine()
+    result = engine.score(synthetic_answers(n, engine, seed=1))
+    return [
+        (result.category_totals(i), engine.max_scores_by_category(), report.scores_frame(result.type_rows(i)))
+        for i in range(len(result))
+    ]
+
+
+# Function to render the charts for one report without help from the in-memory
+# chart cache (leave BIAS_CACHE_DIR unset so the disk tier is not used either)
+def _render_charts_cold(scores_data):
+    import report
+    report.chart_cache.clear()
+    return report.render_category_charts(scores_data)
+
+
+def stage_custom_bar_chart(n):
+    inputs = _report_inputs(n)
+
+    def run():
+        produced = 0
+        for _, _, scores_data in inputs:
+            produced += sum(len(chart.getvalue()) for chart in _render_charts_cold(scores_data))
+        return produced
+    return run
+
+
+def stage_wrap_text(n):
+    import report
+    words = " ".join(batch.default_engine().question_texts).split()
+    text = " ".join(words[i % len(words)] for i in range(200 * n))
+
+    def run():
+        report.wrap_text(text, None, 532, 10)
+        return 0
+    return run
+
+
+def _stage_generate_pdf(n, chart_mode):
+    import report
+    inputs = _report_inputs(n)
+
+    def run():
+        produced = 0
+        for totals, max_scores, scores_data in inputs:
+            chart_images = _render_charts_cold(scores_data) if chart_mode == "png" else None
+            pdf = report.generate_pdf(
+                totals, max_scores, chart_images, scores_data=scores_data, chart_mode=chart_mode
+            )
+            produced += len(pdf.getvalue())
+        return produced
+    return run
+
+
+def stage_generate_pdf_png(n):
+    return _stage_generate_pdf(n, "png")
+
+
+def stage_generate_pdf_vector(n):
+    return _stage_generate_pdf(n, "vector")
+
+
+# File-like sink that only counts the bytes written to it
+class _CountingSink:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def flush(self):
+        pass
+
+
+# Function to write a consolidated cohort PDF with one appendix per respondent,
+# streamed to a counting sink so only the generator itself is measured
+def stage_generate_cohort_pdf(n):
+    from cohort import CohortStats
+    from cohort_report import generate_cohort_pdf
+    engine = batch.default_engine()
+    answers = synthetic_answers(n, engine, seed=1)
+    stats = CohortStats(engine)
+    stats.add_batch(answers)
+    per_group = engine.score(answers).per_group.tolist()
+
+    def run():
+        sink = _CountingSink()
+        respondents = ((i, None, scores) for i, scores in enumerate(per_group))
+        generate_cohort_pdf(sink, stats, respondents=respondents, chart_mode="vector")
+        return sink.size
+    return run
+
+
+# name -> (stage factory, largest respondent count it is run with)
+STAGES = {
+    "total_scores_per_category": (stage_total_scores_per_category, 10000),
+    "score_matrix": (stage_score_matrix, None),
+    "type_aggregation": (stage_type_aggregation, 1000),
+    "cohort_stats": (stage_cohort_stats, None),
+    "custom_bar_chart": (stage_custom_bar_chart, 1),
+    "wrap_text": (stage_wrap_text, 1000),
+    "generate_pdf_png": (stage_generate_pdf_png, 1),
+    "generate_pdf_vector": (stage_generate_pdf_vector, 100),
+    "generate_cohort_pdf": (stage_generate_cohort_pdf, 1000),
+}
+
+
+# Function to measure one stage at one size: best wall time over `repeat` runs,
+# peak traced allocation size, the number of blocks allocated by a run that are
+# still alive after it (caches and leaks, not every allocation), output bytes and
+# the peak RSS of the process
+def measure(name, n, repeat=3, profile_dir=None):
+    factory, _ = STAGES[name]
+    run = factory(n)
+    run()  # Warm caches and lazy imports outside the measurements
+
+    wall = float("inf")
+    produced = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        produced = run()
+        wall = min(wall, time.perf_counter() - started)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    run()
+    after = tracemalloc.take_snapshot()
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retained_blocks = sum(max(stat.count_diff, 0) for stat in after.compare_to(before, "lineno"))
+
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler = cProfile.Profile()
+        profiler.runcall(run)
+        profiler.dump_stats(os.path.join(profile_dir, f"{name}-{n}.prof"))
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+
+    return {
+        "stage": name,
+        "respondents": n,
+        "wall_seconds": wall,
+        "per_respondent_seconds": wall / n,
+        "peak_rss_bytes": peak_rss,
+        "peak_traced_bytes": peak_traced,
+        "retained_blocks": retained_blocks,
+        "output_bytes": produced,
+    }
+
+
+def _measure_in_child(connection, name, n, repeat, profile_dir):
+    try:
+        connection.send(measure(name, n, repeat, profile_dir))
+    except BaseException as e:
+        connection.send({"stage": name, "respondents": n, "error": f"{type(e).__name__}: {e}"})
+    finally:
+        connection.close()
+
+
+# Function to measure a stage in a fresh process so peak RSS belongs to that stage alone
+def measure_isolated(name, n, repeat=3, profile_dir=None):
+    context = multiprocessing.get_context("spawn")
+    parent, child = context.Pipe(duplex=False)
+    process = context.Process(target=_measure_in_child, args=(child, name, n, repeat, profile_dir))
+    process.start()
+    child.close()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+# Function to run every selected stage at every applicable size
+def run_benchmarks(stages=None, sizes=DEFAULT_SIZES, repeat=3, profile_dir=None, isolate=True, progress=None):
+    results = []
+    for name in stages or STAGES:
+        _, max_size = STAGES[name]
+        stage_sizes = sorted({min(n, max_size) if max_size else n for n in sizes})
+        for n in stage_sizes:
+            measure_stage = measure_isolated if isolate else measure
+            result = measure_stage(name, n, repeat, profile_dir)
+            results.append(result)
+            if progress:
+                progress(result)
+    return results
+
+
+# Function to flag results that are slower, or produce more bytes, than the baseline
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    previous = {(r["stage"], r["respondents"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        old = previous.get((result["stage"], result["respondents"]))
+        if old is None or "error" in result or "error" in old:
+            continue
+        for metric in ("wall_seconds", "output_bytes"):
+            if old[metric] and result[metric] > old[metric] * (1 + threshold):
+                regressions.append({
+                    "stage": result["stage"],
+                    "respondents": result["respondents"],
+                    "metric": metric,
+                    "baseline": old[metric],
+                    "current": result[metric],
+                })
+    return regressions
+
+
+def _format_result(result):
+    if "error" in result:
+        return f"{result['stage']:<28} {result['respondents']:>8}  ERROR {result['error']}"
+    return (
+        f"{result['stage']:<28} {result['respondents']:>8}  "
+        f"{result['wall_seconds'] * 1000:>10.2f} ms  "
+        f"{result['peak_rss_bytes'] / 2**20:>7.1f} MiB rss  "
+        f"{result['peak_traced_bytes'] / 2**20:>7.1f} MiB traced  "
+        f"{result['retained_blocks']:>8} retained blocks  "
+        f"{result['output_bytes']:>10} bytes"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the scoring, charting and PDF paths.")
+    parser.add_argument("--stages", help=f"Comma-separated subset of: {', '.join(STAGES)}")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="Comma-separated respondent counts, e.g. 1,1000,1000000")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per measurement (best is kept)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Relative slowdown that counts as a regression")
+    parser.add_argument("--profile-dir", help="Dump a cProfile file per stage and size into this directory")
+    parser.add_argument("--no-isolate", action="store_true", help="Run stages in this process")
+    args = parser.parse_args(argv)
+
+    stages = args.stages.split(",") if args.stages else None
+    unknown = [name for name in stages or () if name not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(unknown)}")
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    results = run_benchmarks(
+        stages, sizes, args.repeat, args.profile_dir, isolate=not args.no_isolate,
+        progress=lambda result: print(_format_result(result)),
+    )
+    report_data = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report_data, f, indent=2)
+
+    status = 1 if any("error" in result for result in results) else 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(
+                f"REGRESSION {regression['stage']} ({regression['respondents']}): "
+                f"{regression['metric']} {regression['baseline']:.6g} -> {regression['current']:.6g}"
+            )
+        if regressions:
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+import argparse
+import os
+import re
+import sys
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+import batch
+from scoring import ScoreResult
+
+# Jobs kept in flight per worker; bounds memory while keeping every worker busy
+JOBS_PER_WORKER = 4
+
+
+# Per-process state, set up once by _init_worker
+_worker_engine = None
+
+
+# Worker initializer: load matplotlib (headless), reportlab, the logo and the
+# questionnaire (the default one when questionnaire is None) up front
+def _init_worker(questionnaire=None):
+    global _worker_engine
+    import report
+    report.warm_up()
+    _worker_engine = batch.engine_for(questionnaire)
+
+
+# Function to build one respondent's PDF from their per-(category, type) scores.
+# Charts and PDFs come from the worker's caches when the scores repeat.
+def render_report(per_group, engine=None, chart_mode=None):
+    import report
+    engine = engine or _worker_engine or batch.default_engine()
+    result = ScoreResult(engine, np.asarray([per_group], dtype=np.int64))
+    scores_data = report.scores_frame(result.type_rows())
+    pdf_buffer = report.report_pdf(
+        result.category_totals(), engine.max_scores_by_category(), scores_data,
+        chart_mode=chart_mode
+    )
+    return pdf_buffer.getvalue()
+
+
+def _render_job(respondent_id, per_group, chart_mode):
+    return respondent_id, render_report(per_group, chart_mode=chart_mode)
+
+
+# Function to turn a respondent id into a safe, unique file name
+def report_file_name(respondent_id, seen):
+    name = re.sub(r"[^A-Za-z0-9._-]+", "_", str(respondent_id)).strip("._") or "respondent"
+    candidate = name
+    suffix = 1
+    while candidate in seen:
+        suffix += 1
+        candidate = f"{name}_{suffix}"
+    seen.add(candidate)
+    return f"{candidate}.pdf"
+
+
+# Sinks receive finished PDFs as they arrive
+class DirectorySink:
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+
+    def write(self, name, data):
+        with open(os.path.join(self.path, name), "wb") as f:
+            f.write(data)
+
+    def close(self):
+        pass
+
+
+class ZipSink:
+    def __init__(self, path):
+        # PDFs are already compressed, so store them as-is
+        self.zip_file = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED)
+
+    def write(self, name, data):
+        self.zip_file.writestr(name, data)
+
+    def close(self):
+        self.zip_file.close()
+
+
+# Function to choose a sink from the output path: *.zip or a directory
+def open_sink(path):
+    if path.lower().endswith(".zip"):
+        return ZipSink(path)
+    return DirectorySink(path)
+
+
+# Function to yield (respondent_id, per-group scores) for every row of a response file
+def iter_jobs(input_path, **kwargs):
+    for ids, result in batch.iter_scored_chunks(input_path, **kwargs):
+        for respondent_id, per_group in zip(ids, result.per_group.tolist()):
+            yield respondent_id, per_group
+
+
+# Function to generate one PDF per respondent across a process pool.
+# Finished reports stream into the sink while at most workers * JOBS_PER_WORKER
+# jobs are pending. progress(done, failed) is called after every finished job.
+# questionnaire names the version the jobs were scored with (default when None).
+# Returns (number written, list of (respondent_id, error message)).
+def generate_reports(jobs, sink, workers=None, progress=None, chart_mode=None, questionnaire=None):
+    workers = workers or os.cpu_count() or 1
+    max_pending = workers * JOBS_PER_WORKER
+    seen_names = set()
+    failures = []
+    done = 0
+    pending = {}
+
+    def collect(finished):
+        nonlocal done
+        for future in finished:
+            respondent_id = pending.pop(future)
+            try:
+                _, data = future.result()
+            except Exception as e:
+                failures.append((respondent_id, f"{type(e).__name__}: {e}"))
+            else:
+                sink.write(report_file_name(respondent_id, seen_names), data)
+                done += 1
+            if progress:
+                progress(done, len(failures))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(questionnaire,)) as pool:
+        for respondent_id, per_group in jobs:
+            if len(pending) >= max_pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+            pending[pool.submit(_render_job, respondent_id, per_group, chart_mode)] = respondent_id
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(finished)
+    return done, failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate PDF reports for every respondent in a response file."
+    )
+    parser.add_argument("input", help="CSV, JSONL or Parquet file with one column per question")
+    parser.add_argument("output", help="Directory, or a .zip file, to write the PDFs to")
+    parser.add_argument("--input-format", choices=batch.FORMATS)
+    parser.add_argument("--id-column", default=batch.DEFAULT_ID_COLUMN)
+    batch.add_questionnaire_argument(parser)
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--chart-mode", choices=("png", "vector"), default=None,
+                        help="Embed charts as PNG images or draw them as vector graphics")
+    parser.add_argument("--quiet", action="store_true", help="Do not report progress")
+    args = parser.parse_args(argv)
+
+    def report_progress(done, failed):
+        if (done + failed) % 50 == 0:
+            print(f"{done} reports written, {failed} failed", file=sys.stderr)
+
+    started = time.perf_counter()
+    sink = open_sink(args.output)
+    try:
+        engine = batch.engine_for(args.questionnaire)
+        jobs = iter_jobs(args.input, engine=engine, input_format=args.input_format, id_column=args.id_column)
+        done, failures = generate_reports(
+            jobs, sink, workers=args.workers, chart_mode=args.chart_mode, questionnaire=engine.index.key,
+            progress=None if args.quiet else report_progress,
+        )
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        sink.close()
+
+    for respondent_id, message in failures:
+        print(f"Failed {respondent_id}: {message}", file=sys.stderr)
+    if not args.quiet:
+        print(
+            f"Done: {done} reports, {len(failures)} failed in {time.perf_counter() - started:.1f}s",
+            file=sys.stderr,
+        )
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
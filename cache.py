@@ -0,0 +1,136 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+# Function to derive a stable content address for a cache key
+def key_digest(key):
+    return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+
+# Bounded LRU cache of bytes values, keyed by any hashable tuple with a stable repr.
+# The memory tier holds at most max_entries values and max_bytes bytes. When
+# disk_dir is set, values are also written there under their content address,
+# so they survive restarts and can be shared by processes using the same directory.
+class LRUCache:
+    def __init__(self, max_entries=128, max_bytes=64 * 1024 * 1024, disk_dir=None,
+                 disk_max_entries=4096):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._disk_writes = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        value = self._disk_get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._memory_put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._memory_put(key, value)
+        self._disk_put(key, value)
+
+    # Function to return the cached value or compute, store and return it
+    def get_or_create(self, key, create):
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+    def _memory_put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._entries[key] = value
+        self._bytes += len(value)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key_digest(key))
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path)  # Keep recently used files out of pruning
+            return value
+        except OSError:
+            return None
+
+    def _disk_put(self, key, value):
+        if not self.disk_dir:
+            return
+        try:
+            # Write to a temporary file first so readers never see partial values
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError:
+            return
+        self._disk_writes += 1
+        if self._disk_writes % 64 == 0:
+            self._prune_disk()
+
+    # Function to drop the least recently used files once the disk tier is over budget
+    def _prune_disk(self):
+        try:
+            entries = [entry for entry in os.scandir(self.disk_dir) if entry.is_file()]
+        except OSError:
+            return
+        excess = len(entries) - self.disk_max_entries
+        if excess <= 0:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:excess]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
@@ -0,0 +1,189 @@
+import argparse
+import sys
+
+import numpy as np
+
+import batch
+from questionnaire import MAX_SCORE_PER_QUESTION
+
+# Percentiles reported by the summaries unless others are asked for
+DEFAULT_PERCENTILES = (25, 50, 75, 90)
+
+
+# Function to compute count, mean, variance and percentiles from histograms.
+# counts has one row per item and one column per integer value in values.
+def histogram_summary(counts, values, percentiles=DEFAULT_PERCENTILES):
+    counts = np.asarray(counts, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    n = counts.sum(axis=1)
+    safe_n = np.maximum(n, 1)
+    mean = counts @ values / safe_n
+    variance = np.maximum(counts @ (values ** 2) / safe_n - mean ** 2, 0)
+    cumulative = counts.cumsum(axis=1)
+    summary = {"count": n, "mean": mean, "variance": variance}
+    for p in percentiles:
+        # Nearest-rank percentile: the smallest value covering p% of the items
+        rank = np.maximum(np.ceil(p / 100 * n), 1)
+        summary[f"p{p}"] = values[np.argmax(cumulative >= rank[:, None], axis=1)]
+    empty = n == 0
+    for key in summary:
+        if key != "count":
+            summary[key] = np.where(empty, np.nan, summary[key])
+    return summary
+
+
+# Function to add the values of an integer matrix to per-column histograms
+def _accumulate(histogram, matrix):
+    columns, width = histogram.shape
+    flat = (np.arange(columns) * width + matrix).ravel()
+    histogram += np.bincount(flat, minlength=columns * width).reshape(columns, width)
+
+
+# Running statistics over many scored assessments. Everything is kept as
+# histograms of integer scores: per question (0 = unanswered, 1-5), per
+# (category, type) score and per category score. Adding a submission touches a
+# fixed number of cells whatever the cohort size, and two accumulators built on
+# separate shards merge exactly by adding their histograms.
+class CohortStats:
+    def __init__(self, engine=None):
+        self.engine = engine or batch.default_engine()
+        self.count = 0
+        self.question_counts = np.zeros((self.engine.num_questions, MAX_SCORE_PER_QUESTION + 1), dtype=np.int64)
+        self.group_counts = np.zeros(
+            (len(self.engine.groups), int(self.engine.max_scores_per_group.max()) + 1), dtype=np.int64
+        )
+        self.category_counts = np.zeros(
+            (len(self.engine.category_names), int(self.engine.max_scores_per_category.max()) + 1), dtype=np.int64
+        )
+
+    # Function to add one respondent's answers (a row indexed by question id)
+    def add(self, answers):
+        self.add_batch(np.asarray(answers)[None, :])
+
+    # Function to add a (respondents x questions) matrix of answers
+    def add_batch(self, matrix):
+        matrix = np.atleast_2d(np.asarray(matrix, dtype=np.int64))
+        if matrix.shape[0] == 0:
+            return
+        result = self.engine.score(matrix)
+        _accumulate(self.question_counts, matrix)
+        _accumulate(self.group_counts, result.per_group)
+        _accumulate(self.category_counts, result.per_category)
+        self.count += matrix.shape[0]
+
+    # Function to fold another accumulator (e.g. from another shard) into this one
+    def merge(self, other):
+        if other.question_counts.shape != self.question_counts.shape:
+            raise ValueError("Cannot merge statistics for different questionnaires")
+        self.count += other.count
+        self.question_counts += other.question_counts
+        self.group_counts += other.group_counts
+        self.category_counts += other.category_counts
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def question_summary(self, percentiles=DEFAULT_PERCENTILES):
+        # Unanswered questions are counted separately and left out of the statistics
+        summary = histogram_summary(
+            self.question_counts[:, 1:], np.arange(1, MAX_SCORE_PER_QUESTION + 1), percentiles
+        )
+        summary["unanswered"] = self.question_counts[:, 0].copy()
+        return summary
+
+    def group_summary(self, percentiles=DEFAULT_PERCENTILES):
+        return histogram_summary(self.group_counts, np.arange(self.group_counts.shape[1]), percentiles)
+
+    def category_summary(self, percentiles=DEFAULT_PERCENTILES):
+        return histogram_summary(self.category_counts, np.arange(self.category_counts.shape[1]), percentiles)
+
+    # Rows of Category / Type / Score / Percentage with the cohort mean score per type
+    def type_rows(self):
+        mean = self.group_summary(())["mean"]
+        return [
+            {
+                "Category": category_name,
+                "Type": type_name,
+                "Score": float(mean[g]),
+                "Percentage": float(mean[g] / self.engine.max_scores_per_group[g] * 100),
+            }
+            for g, (category_name, type_name) in enumerate(self.engine.groups)
+        ]
+
+    # The same sorted frame that the per-respondent charts are drawn from
+    def scores_frame(self):
+        import report
+        return report.scores_frame(self.type_rows())
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                questionnaire=self.engine.index.key or "",
+                count=self.count,
+                question_counts=self.question_counts,
+                group_counts=self.group_counts,
+                category_counts=self.category_counts,
+            )
+
+    @classmethod
+    def load(cls, path, engine=None):
+        stats = cls(engine)
+        with np.load(path) as data:
+            saved_key = str(data["questionnaire"]) if "questionnaire" in data else ""
+            if saved_key and stats.engine.index.key and saved_key != stats.engine.index.key:
+                raise ValueError(f"{path!r} holds statistics for {saved_key}, not {stats.engine.index.key}")
+            for name in ("question_counts", "group_counts", "category_counts"):
+                if data[name].shape != getattr(stats, name).shape:
+                    raise ValueError(f"{path!r} holds statistics for a different questionnaire")
+                setattr(stats, name, data[name].astype(np.int64))
+            stats.count = int(data["count"])
+        return stats
+
+
+# Function to build cohort statistics from a response file, one chunk at a time
+def stats_from_file(path, engine=None, **kwargs):
+    stats = CohortStats(engine)
+    for _, matrix in batch.iter_encoded_chunks(path, stats.engine, **kwargs):
+        stats.add_batch(matrix)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Summarise a cohort of assessments; inputs may be response files or saved .npz statistics."
+    )
+    parser.add_argument("inputs", nargs="+", help="Response files (CSV, JSONL, Parquet) or .npz statistics to merge")
+    parser.add_argument("--save", help="Write the merged statistics to this .npz file")
+    parser.add_argument("--id-column", default=batch.DEFAULT_ID_COLUMN)
+    batch.add_questionnaire_argument(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        stats = CohortStats(batch.engine_for(args.questionnaire))
+        for path in args.inputs:
+            if path.lower().endswith(".npz"):
+                stats.merge(CohortStats.load(path, stats.engine))
+            else:
+                stats.merge(stats_from_file(path, stats.engine, id_column=args.id_column))
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    if args.save:
+        stats.save(args.save)
+
+    summary = stats.category_summary()
+    print(f"Respondents: {stats.count}")
+    for c, category_name in enumerate(stats.engine.category_names):
+        max_score = int(stats.engine.max_scores_per_category[c])
+        print(
+            f"{category_name}: mean {summary['mean'][c]:.1f} of {max_score}, "
+            f"sd {np.sqrt(summary['variance'][c]):.1f}, median {summary['p50'][c]:.0f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+import argparse
+import os
+import sys
+import time
+from itertools import repeat
+
+import numpy as np
+
+import batch
+from cohort import CohortStats
+from scoring import ScoreResult
+
+
+# Function to start a section: the logo, a bold title and an optional subtitle
+def _section_heading(c, flow, title, subtitle=None, on_logo_error=None):
+    import report
+    report.draw_logo(c, flow, on_logo_error)
+    flow.set_font("Helvetica-Bold", 12)
+    flow.line(title, leading=20)
+    flow.set_font("Helvetica", 10)
+    if subtitle:
+        flow.line(subtitle, leading=15)
+
+
+# Function to draw one line per category with the cohort's mean and median score
+def _draw_cohort_scores(flow, stats):
+    summary = stats.category_summary((50,))
+    engine = stats.engine
+    for c, category_name in enumerate(engine.category_names):
+        max_score = int(engine.max_scores_per_category[c])
+        mean = summary["mean"][c]
+        flow.line(
+            f"{category_name}: mean {mean:.1f} out of {max_score} ({int(mean / max_score * 100)}%), "
+            f"median {summary['p50'][c]:.0f}",
+            leading=15,
+        )
+
+
+# Function to write one PDF covering a whole cohort: a summary of everyone, one
+# section per team and, optionally, one appendix per respondent.
+# Pages are streamed to output (a path or binary file object) as they are finished
+# and teams and respondents are consumed one at a time, so memory stays flat however
+# many respondents there are. The logo and fonts are written once per document.
+# teams yields (team name, CohortStats) pairs; respondents yields
+# (respondent id, team or None, per-(category, type) scores) triples.
+# progress(sections) is called after every team and respondent section.
+# Returns the number of pages written.
+def generate_cohort_pdf(output, stats, teams=(), respondents=(), chart_mode=None,
+                        on_logo_error=None, progress=None):
+    import report
+    from reportlab.lib.pagesizes import letter
+    from layout import PageFlow
+    from pdfstream import StreamingCanvas
+    chart_mode = chart_mode or report.CHART_MODE
+    if chart_mode not in report.CHART_MODES:
+        raise ValueError(f"Unknown chart mode {chart_mode!r}; use one of {', '.join(report.CHART_MODES)}")
+    if stats.count == 0:
+        raise ValueError("The cohort has no respondents")
+    engine = stats.engine
+    max_scores_per_category = engine.max_scores_by_category()
+
+    c = StreamingCanvas(output, pagesize=letter)
+    width, height = letter
+    margin = report.PAGE_MARGIN
+    flow = PageFlow(c, height, margin)
+
+    # Summary of the whole cohort, with charts of the mean score per type
+    _section_heading(
+        c, flow, "LEAD Network Anti-Bias Self Assessment Tool",
+        f"Cohort results: {stats.count} respondents", on_logo_error,
+    )
+    _draw_cohort_scores(flow, stats)
+    flow.skip(10)  # Extra space before explanations
+    flow.block(report.layout_explanations(width - 2 * margin, 10))
+    c.showPage()
+    report.draw_charts(c, letter, stats.scores_frame(), chart_mode=chart_mode)
+
+    sections = 0
+
+    # One section per team, each starting on a new page
+    for team, team_stats in teams:
+        flow.new_page()
+        _section_heading(c, flow, f"Team: {team}", f"{team_stats.count} respondents", on_logo_error)
+        _draw_cohort_scores(flow, team_stats)
+        report.draw_charts(c, letter, team_stats.scores_frame(), chart_mode=chart_mode, y=flow.y - 10)
+        sections += 1
+        if progress:
+            progress(sections)
+
+    # Respondent appendices
+    for respondent_id, team, per_group in respondents:
+        result = ScoreResult(engine, np.asarray([per_group], dtype=np.int64))
+        flow.new_page()
+        _section_heading(
+            c, flow, f"Respondent {respondent_id}",
+            f"Team: {team}" if team is not None else None, on_logo_error,
+        )
+        report.draw_category_scores(flow, result.category_totals(), max_scores_per_category)
+        report.draw_charts(c, letter, report.scores_frame(result.type_rows()), chart_mode=chart_mode, y=flow.y - 10)
+        sections += 1
+        if progress:
+            progress(sections)
+
+    pages = c.getPageNumber()
+    c.save()
+    return pages
+
+
+# Function to build cohort statistics from a response file in one pass, overall and
+# per team when team_column is given. Returns (stats, [(team, CohortStats)]) with
+# the teams sorted by name.
+def cohort_from_file(path, team_column=None, engine=None, **kwargs):
+    stats = CohortStats(engine)
+    teams = {}
+    if team_column is None:
+        for _, matrix in batch.iter_encoded_chunks(path, stats.engine, **kwargs):
+            stats.add_batch(matrix)
+        return stats, []
+    for _, labels, matrix in batch.iter_labelled_chunks(path, team_column, stats.engine, **kwargs):
+        stats.add_batch(matrix)
+        labels = np.asarray(labels)
+        for team in np.unique(labels).tolist():
+            if team not in teams:
+                teams[team] = CohortStats(stats.engine)
+            teams[team].add_batch(matrix[labels == team])
+    return stats, sorted(teams.items())
+
+
+# Function to yield (respondent id, team, per-group scores) for every row of a
+# response file, in file order; team is None without a team_column
+def iter_respondents(path, team_column=None, engine=None, **kwargs):
+    engine = engine or batch.default_engine()
+    if team_column is None:
+        for ids, matrix in batch.iter_encoded_chunks(path, engine, **kwargs):
+            yield from zip(ids, repeat(None), engine.score(matrix).per_group.tolist())
+    else:
+        for ids, labels, matrix in batch.iter_labelled_chunks(path, team_column, engine, **kwargs):
+            yield from zip(ids, labels, engine.score(matrix).per_group.tolist())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate one consolidated PDF report for a cohort of respondents."
+    )
+    parser.add_argument("input", help="CSV, JSONL or Parquet file with one column per question")
+    parser.add_argument("output", help="PDF file to write")
+    parser.add_argument("--team-column", help="Column naming each respondent's team; adds a section per team")
+    parser.add_argument("--appendices", action="store_true", help="Add a page per respondent")
+    parser.add_argument("--input-format", choices=batch.FORMATS)
+    parser.add_argument("--id-column", default=batch.DEFAULT_ID_COLUMN)
+    batch.add_questionnaire_argument(parser)
+    parser.add_argument("--chart-mode", choices=("png", "vector"), default=None,
+                        help="Embed charts as PNG images or draw them as vector graphics (much faster for large cohorts)")
+    parser.add_argument("--quiet", action="store_true", help="Do not report progress")
+    args = parser.parse_args(argv)
+
+    def report_progress(sections):
+        if sections % 50 == 0:
+            print(f"{sections} sections written", file=sys.stderr)
+
+    started = time.perf_counter()
+    read_options = {"input_format": args.input_format, "id_column": args.id_column}
+    opened = False
+    try:
+        engine = batch.engine_for(args.questionnaire)
+        stats, teams = cohort_from_file(args.input, args.team_column, engine, **read_options)
+        respondents = (
+            iter_respondents(args.input, args.team_column, stats.engine, **read_options)
+            if args.appendices else ()
+        )
+        with open(args.output, "wb") as f:
+            opened = True
+            pages = generate_cohort_pdf(
+                f, stats, teams, respondents, chart_mode=args.chart_mode,
+                progress=None if args.quiet else report_progress,
+            )
+    except (OSError, ValueError, RuntimeError) as e:
+        if opened:
+            os.remove(args.output)  # Do not leave a truncated PDF behind
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    if not args.quiet:
+        print(
+            f"Done: {stats.count} respondents, {len(teams)} teams, {pages} pages "
+            f"in {time.perf_counter() - started:.1f}s",
+            file=sys.stderr,
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
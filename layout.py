@@ -0,0 +1,96 @@
+from reportlab.pdfbase.pdfmetrics import getFont
+
+
+# Word widths in 1/1000 em per font name. Widths are additive for the standard
+# fonts, so each distinct word is measured once and reused at every font size.
+_word_widths = {}
+
+
+# Function to get the (cached) width table for a font
+def _font_widths(font_name):
+    widths = _word_widths.get(font_name)
+    if widths is None:
+        widths = _word_widths[font_name] = {" ": getFont(font_name).stringWidth(" ", 1000)}
+    return widths
+
+
+# Function to measure one word at 1000 units per em, measuring it only the first time
+def word_width(word, font_name="Helvetica"):
+    widths = _font_widths(font_name)
+    width = widths.get(word)
+    if width is None:
+        width = widths[word] = getFont(font_name).stringWidth(word, 1000)
+    return width
+
+
+# Function to wrap text greedily into lines no wider than max_width, in time linear
+# in the number of words. A line fits when its text plus a trailing space fits, and
+# a single word wider than max_width is put on a line of its own.
+def wrap_words(text, max_width, font_name="Helvetica", font_size=10):
+    widths = _font_widths(font_name)
+    space = widths[" "]
+    limit = max_width * 1000 / font_size
+    lines = []
+    line = []
+    line_width = 0
+    for word in text.split():
+        width = widths.get(word)
+        if width is None:
+            width = word_width(word, font_name)
+        if line and line_width + width + space > limit:
+            lines.append(" ".join(line))
+            line = []
+            line_width = 0
+        if not line and width + space > limit:
+            lines.append(word)
+            continue
+        line.append(word)
+        line_width += width + space
+    if line:
+        lines.append(" ".join(line))
+    return lines
+
+
+# Lays lines out top to bottom on a canvas, starting a new page whenever the next
+# line would run into the bottom margin. Because each finished page is handed to
+# the canvas straight away, a streaming canvas writes it out immediately.
+class PageFlow:
+    def __init__(self, canvas, page_height, margin, y=None):
+        self.canvas = canvas
+        self.margin = margin
+        self.top = page_height - margin
+        self.y = self.top if y is None else y
+        self.font = ("Helvetica", 12)
+
+    def new_page(self):
+        self.canvas.showPage()
+        self.canvas.setFont(*self.font)
+        self.y = self.top
+
+    # Function to start a new page unless `needed` points of space are left
+    def ensure_space(self, needed):
+        if self.y - needed < self.margin:
+            self.new_page()
+
+    def set_font(self, font_name, font_size):
+        self.font = (font_name, font_size)
+        self.canvas.setFont(font_name, font_size)
+
+    def line(self, text, leading=12, x=None):
+        self.ensure_space(15)
+        self.canvas.drawString(self.margin if x is None else x, self.y, text)
+        self.y -= leading
+
+    def skip(self, points):
+        self.y -= points
+
+    # Function to draw a precomputed block of ("font", name, size), ("line", text)
+    # and ("gap", points) steps
+    def block(self, steps, leading=12):
+        for step in steps:
+            if step[0] == "line":
+                self.line(step[1], leading)
+            elif step[0] == "font":
+                self.set_font(step[1], step[2])
+            else:
+                self.skip(step[1])
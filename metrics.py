@@ -0,0 +1,318 @@
+import bisect
+import os
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Metrics are collected only when an exporter is configured (or BIAS_METRICS=1):
+# BIAS_METRICS_FILE rewrites a Prometheus text file every BIAS_METRICS_INTERVAL
+# seconds, and BIAS_METRICS_PORT serves the same text at http://host:port/metrics.
+# When disabled, every call below returns a shared no-op, so instrumented code
+# pays for one attribute check and nothing else.
+METRICS_FILE = os.environ.get("BIAS_METRICS_FILE")
+METRICS_PORT = int(os.environ.get("BIAS_METRICS_PORT", 0))
+METRICS_HOST = os.environ.get("BIAS_METRICS_HOST", "127.0.0.1")
+METRICS_INTERVAL = float(os.environ.get("BIAS_METRICS_INTERVAL", 15))
+ENABLED = bool(METRICS_FILE or METRICS_PORT) or os.environ.get("BIAS_METRICS", "") == "1"
+
+# Latency buckets in seconds, from a fast rerun to a slow PDF
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Size buckets in bytes, from a small chart to a large PDF
+BYTES_BUCKETS = tuple(2 ** power for power in range(10, 25, 2))
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in key) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+# Metric whose samples are read from a function at export time, for values that
+# are already tracked elsewhere (such as cache statistics). fn returns a list of
+# (labels dict, value) pairs.
+class CallbackMetric:
+    def __init__(self, name, help, type, fn):
+        self.name = name
+        self.help = help
+        self.type = type
+        self._fn = fn
+
+    def samples(self):
+        return [(self.name, _label_key(labels), value) for labels, value in self._fn()]
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}  # label key -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[position] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        samples = []
+        bounds = [_format_value(bound) for bound in self.buckets] + ["+Inf"]
+        for key, values in series.items():
+            cumulative = 0
+            for bound, count in zip(bounds, values):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", key + (("le", bound),), cumulative))
+            samples.append((f"{self.name}_count", key, cumulative))
+            samples.append((f"{self.name}_sum", key, values[-1]))
+        return samples
+
+
+# Number of distinct keys (such as sessions) seen in the last `window` seconds
+class ActiveGauge:
+    type = "gauge"
+
+    def __init__(self, name, help, window):
+        self.name = name
+        self.help = help
+        self.window = window
+        self._last_seen = {}
+        self._lock = threading.Lock()
+
+    def touch(self, key):
+        with self._lock:
+            self._last_seen[key] = time.monotonic()
+
+    def samples(self):
+        cutoff = time.monotonic() - self.window
+        with self._lock:
+            for key in [key for key, seen in self._last_seen.items() if seen < cutoff]:
+                del self._last_seen[key]
+            return [(self.name, (), len(self._last_seen))]
+
+
+# Times the block it wraps into a histogram, as one observation per labels set
+class Span:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class _NoopMetric:
+    def inc(self, amount=1, **labels):
+        pass
+
+    def dec(self, amount=1, **labels):
+        pass
+
+    def set(self, value, **labels):
+        pass
+
+    def observe(self, value, **labels):
+        pass
+
+    def touch(self, key):
+        pass
+
+
+_NOOP = _NoopMetric()
+_NOOP_SPAN = nullcontext()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    # Function to render every metric in the Prometheus text exposition format
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name, help):
+    return registry.register(Counter(name, help)) if ENABLED else _NOOP
+
+
+def gauge(name, help):
+    return registry.register(Gauge(name, help)) if ENABLED else _NOOP
+
+
+def histogram(name, help, buckets=SECONDS_BUCKETS):
+    return registry.register(Histogram(name, help, buckets)) if ENABLED else _NOOP
+
+
+def active_gauge(name, help, window=300):
+    return registry.register(ActiveGauge(name, help, window)) if ENABLED else _NOOP
+
+
+def callback(name, help, type, fn):
+    return registry.register(CallbackMetric(name, help, type, fn)) if ENABLED else _NOOP
+
+
+# Stage latencies and output sizes shared by every instrumented module
+stage_seconds = histogram("bias_stage_seconds", "Time spent in each stage")
+stage_bytes = histogram("bias_stage_bytes", "Size of the output produced by each stage", BYTES_BUCKETS)
+
+
+# Function to time a block as one observation of bias_stage_seconds{stage=...}
+def span(stage):
+    if not ENABLED:
+        return _NOOP_SPAN
+    return Span(stage_seconds, {"stage": stage})
+
+
+# Function to record the size of something a stage produced
+def record_bytes(stage, size):
+    if ENABLED:
+        stage_bytes.observe(size, stage=stage)
+
+
+_watched_caches = {}
+
+
+# Function to export the statistics of an LRUCache (hits, misses, size) as metrics
+def watch_cache(name, cache):
+    if not ENABLED:
+        return
+    _watched_caches[name] = cache
+    for stat, metric_type in (("hits", "counter"), ("disk_hits", "counter"), ("misses", "counter"),
+                              ("entries", "gauge"), ("bytes", "gauge")):
+        callback(
+            f"bias_cache_{stat}_total" if metric_type == "counter" else f"bias_cache_{stat}",
+            f"Cache {stat.replace('_', ' ')}", metric_type,
+            lambda stat=stat: [({"cache": name}, cache.stats()[stat]) for name, cache in _watched_caches.items()],
+        )
+
+
+# Function to write the metrics to a file atomically, so scrapers never read a partial file
+def write_file(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+
+# Function to start the configured exporters, at most once per process
+def start_exporters():
+    global _exporters_started
+    if not ENABLED:
+        return
+    with _exporters_lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+    if METRICS_PORT:
+        server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), _MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    if METRICS_FILE:
+        def export_file():
+            while True:
+                try:
+                    write_file(METRICS_FILE)
+                except OSError:
+                    pass
+                time.sleep(METRICS_INTERVAL)
+        threading.Thread(target=export_file, name="metrics-file", daemon=True).start()
@@ -0,0 +1,241 @@
+import hashlib
+import os
+import weakref
+import zlib
+from io import BytesIO
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase.pdfmetrics import stringWidth
+
+# Encoded image streams of shared images (drawn with reuse=True), kept per process
+# for as long as their ImageReader lives, so the logo is decoded and compressed once
+_encoded_images = weakref.WeakKeyDictionary()
+
+
+# Function to format a number for a content stream
+def _num(value):
+    text = f"{value:.3f}".rstrip("0").rstrip(".")
+    return "0" if text in ("", "-0") else text
+
+
+# Function to encode text as an escaped PDF string literal (WinAnsi encoding)
+def _pdf_string(text):
+    data = text.encode("cp1252", "replace")
+    data = data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)").replace(b"\r", b"\\r")
+    return b"(" + data + b")"
+
+
+# Function to decode and compress an image into (width, height, stream data)
+def _encode_image(reader):
+    image_width, image_height = reader.getSize()
+    return image_width, image_height, zlib.compress(reader.getRGBData(), 6)
+
+
+def _encode_shared_image(reader):
+    encoded = _encoded_images.get(reader)
+    if encoded is None:
+        encoded = _encoded_images[reader] = _encode_image(reader)
+    return encoded
+
+
+# Minimal PDF canvas that writes every page to its sink as soon as the page is
+# finished, so memory stays flat however many pages a document has. Fonts and
+# images are written once per document and shared by every page that uses them.
+# It supports the subset of the reportlab Canvas API used by the reports.
+class StreamingCanvas:
+    def __init__(self, sink, pagesize=letter):
+        if isinstance(sink, (str, os.PathLike)):
+            self._file = open(sink, "wb")
+            self._owns_file = True
+        else:
+            self._file = sink
+            self._owns_file = False
+        self._pagesize = pagesize
+        self._position = 0
+        self._offsets = [None, None, None]  # Object 1 is the catalog, 2 the page tree
+        self._page_ids = []
+        self._fonts = {}  # font name -> (resource name, object id)
+        self._images = {}  # image key -> (resource name, object id, width, height)
+        self._image_readers = []
+        self._image_count = 0
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self._start_page()
+
+    # Graphics state, reset at the start of every page like reportlab does
+    def _start_page(self):
+        self._ops = []
+        self._page_fonts = set()
+        self._page_images = set()
+        self._font = ("Helvetica", 12)
+        self._state_stack = []
+
+    def getPageNumber(self):
+        return len(self._page_ids) + 1
+
+    # Text
+
+    def setFont(self, name, size):
+        self._font = (name, size)
+
+    def stringWidth(self, text, font_name=None, font_size=None):
+        return stringWidth(text, font_name or self._font[0], font_size or self._font[1])
+
+    def drawString(self, x, y, text):
+        name, size = self._font
+        resource = self._font_resource(name)
+        self._ops.append(
+            b"BT /" + resource.encode() + b" " + _num(size).encode() + b" Tf "
+            + f"{_num(x)} {_num(y)} Td ".encode() + _pdf_string(text) + b" Tj ET"
+        )
+
+    def drawCentredString(self, x, y, text):
+        self.drawString(x - self.stringWidth(text) / 2, y, text)
+
+    def drawRightString(self, x, y, text):
+        self.drawString(x - self.stringWidth(text), y, text)
+
+    # Graphics
+
+    def setFillColor(self, color):
+        r, g, b = colors.toColor(color).rgb()
+        self._ops.append(f"{_num(r)} {_num(g)} {_num(b)} rg".encode())
+
+    def setStrokeColor(self, color):
+        r, g, b = colors.toColor(color).rgb()
+        self._ops.append(f"{_num(r)} {_num(g)} {_num(b)} RG".encode())
+
+    def setLineWidth(self, width):
+        self._ops.append(f"{_num(width)} w".encode())
+
+    def saveState(self):
+        self._state_stack.append(self._font)
+        self._ops.append(b"q")
+
+    def restoreState(self):
+        self._font = self._state_stack.pop()
+        self._ops.append(b"Q")
+
+    def rect(self, x, y, width, height, stroke=1, fill=0):
+        paint = {(1, 0): "S", (0, 1): "f", (1, 1): "B"}.get((bool(stroke), bool(fill)), "n")
+        self._ops.append(f"{_num(x)} {_num(y)} {_num(width)} {_num(height)} re {paint}".encode())
+
+    def line(self, x1, y1, x2, y2):
+        self._ops.append(f"{_num(x1)} {_num(y1)} m {_num(x2)} {_num(y2)} l S".encode())
+
+    # image may be an ImageReader, a path, image file bytes or a binary file object.
+    # A path, or an ImageReader drawn with reuse=True (such as the logo), is written
+    # once and only referenced after that. Bytes and file objects are matched by the
+    # hash of their content, so a repeated chart is also written once. Apart from
+    # shared readers, decoded pixels are dropped as soon as the image is written,
+    # so memory does not grow with the number of images in the document.
+    def drawImage(self, image, x, y, width=None, height=None, reuse=False):
+        if isinstance(image, ImageReader):
+            key = ("reader", id(image)) if reuse else None
+            resource = self._images.get(key) if reuse else None
+            if resource is None:
+                resource = self._write_image(_encode_shared_image(image) if reuse else _encode_image(image))
+                if reuse:
+                    self._images[key] = resource
+                    self._image_readers.append(image)  # Keep alive so id(image) stays unique
+        else:
+            if isinstance(image, (str, os.PathLike)):
+                key = ("path", os.fspath(image))
+                data = None
+            else:
+                data = bytes(image) if isinstance(image, (bytes, bytearray, memoryview)) else image.read()
+                key = ("sha256", hashlib.sha256(data).digest())
+            resource = self._images.get(key)
+            if resource is None:
+                reader = ImageReader(key[1] if data is None else BytesIO(data))
+                resource = self._images[key] = self._write_image(_encode_image(reader))
+        name, object_id, image_width, image_height = resource
+        self._page_images.add((name, object_id))
+        width = image_width if width is None else width
+        height = image_height if height is None else height
+        self._ops.append(f"q {_num(width)} 0 0 {_num(height)} {_num(x)} {_num(y)} cm /{name} Do Q".encode())
+
+    # Pages and document
+
+    def showPage(self):
+        content = zlib.compress(b"\n".join(self._ops) + b"\n")
+        content_id = self._new_object()
+        self._write_stream(content_id, "/Filter /FlateDecode", content)
+
+        fonts = " ".join(f"/{name} {object_id} 0 R" for name, object_id in sorted(self._page_fonts))
+        images = " ".join(f"/{name} {object_id} 0 R" for name, object_id in sorted(self._page_images))
+        resources = f"/ProcSet [/PDF /Text /ImageC] /Font << {fonts} >>"
+        if images:
+            resources += f" /XObject << {images} >>"
+        page_width, page_height = self._pagesize
+        page_id = self._new_object()
+        self._write_object(
+            page_id,
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {_num(page_width)} {_num(page_height)}] "
+            f"/Resources << {resources} >> /Contents {content_id} 0 R >>".encode(),
+        )
+        self._page_ids.append(page_id)
+        self._start_page()
+
+    def save(self):
+        if self._ops or not self._page_ids:
+            self.showPage()
+        kids = " ".join(f"{page_id} 0 R" for page_id in self._page_ids)
+        self._write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>".encode())
+        self._write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+        xref_position = self._position
+        lines = [f"xref\n0 {len(self._offsets)}\n", "0000000000 65535 f \n"]
+        lines += [f"{offset:010d} 00000 n \n" for offset in self._offsets[1:]]
+        lines.append(f"trailer\n<< /Size {len(self._offsets)} /Root 1 0 R >>\nstartxref\n{xref_position}\n%%EOF\n")
+        self._write("".join(lines).encode())
+        if self._owns_file:
+            self._file.close()
+        else:
+            self._file.flush()
+
+    # Low-level object writing
+
+    def _write(self, data):
+        self._file.write(data)
+        self._position += len(data)
+
+    def _new_object(self):
+        self._offsets.append(None)
+        return len(self._offsets) - 1
+
+    def _write_object(self, object_id, body):
+        self._offsets[object_id] = self._position
+        self._write(f"{object_id} 0 obj\n".encode() + body + b"\nendobj\n")
+
+    def _write_stream(self, object_id, dictionary, data):
+        self._write_object(
+            object_id,
+            f"<< {dictionary} /Length {len(data)} >>\nstream\n".encode() + data + b"\nendstream",
+        )
+
+    def _write_image(self, encoded):
+        image_width, image_height, data = encoded
+        object_id = self._new_object()
+        self._write_stream(
+            object_id,
+            f"/Type /XObject /Subtype /Image /Width {image_width} /Height {image_height} "
+            "/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode",
+            data,
+        )
+        self._image_count += 1
+        return (f"Im{self._image_count}", object_id, image_width, image_height)
+
+    def _font_resource(self, name):
+        resource = self._fonts.get(name)
+        if resource is None:
+            object_id = self._new_object()
+            self._write_object(
+                object_id,
+                f"<< /Type /Font /Subtype /Type1 /BaseFont /{name} /Encoding /WinAnsiEncoding >>".encode(),
+            )
+            resource = (f"F{len(self._fonts) + 1}", object_id)
+            self._fonts[name] = resource
+        self._page_fonts.add(resource)
+        return resource[0]
@@ -0,0 +1,336 @@
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+
+import numpy as np
+
+# Maximum score a single question can receive on the rating scale
+MAX_SCORE_PER_QUESTION = 5
+
+# Directory of questionnaire definitions. Each file is one version of one
+# questionnaire, named "<name>@<version>.json" (or .yaml / .yml).
+QUESTIONNAIRE_DIR = os.environ.get(
+    "BIAS_QUESTIONNAIRE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "questionnaires")
+)
+# Directory the compiled indexes are written to and memory-mapped from
+COMPILED_DIR = os.environ.get("BIAS_QUESTIONNAIRE_CACHE") or os.path.join(QUESTIONNAIRE_DIR, "compiled")
+# Questionnaire used by default, as "<name>" (its latest version) or "<name>@<version>"
+DEFAULT_QUESTIONNAIRE = os.environ.get("BIAS_QUESTIONNAIRE", "anti-bias")
+
+_DEFINITION_FILE = re.compile(r"^(?P<name>[\w.-]+)@(?P<version>\d+)\.(?P<format>json|ya?ml)$")
+
+
+# Function to read and check a questionnaire definition file. The file holds
+# {"categories": [{"name", "types": [{"name", "questions": [text, ...]}]}]};
+# order in the file is the order of the question ids.
+def load_definition(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError as e:
+            raise RuntimeError("YAML questionnaires require the 'PyYAML' package") from e
+        definition = yaml.safe_load(data)
+    else:
+        definition = json.loads(data)
+    return definition_categories(definition, path)
+
+
+# Function to turn a parsed definition into the {category: {type: [questions]}}
+# form, raising ValueError on anything the scoring engine cannot handle
+def definition_categories(definition, source="questionnaire"):
+    if not isinstance(definition, dict) or not isinstance(definition.get("categories"), list):
+        raise ValueError(f"{source}: expected an object with a 'categories' list")
+    categories = {}
+    seen_questions = set()
+    for category in definition["categories"]:
+        category_name = category.get("name")
+        if not isinstance(category_name, str) or not category_name or category_name in categories:
+            raise ValueError(f"{source}: category names must be unique, non-empty strings ({category_name!r})")
+        types = categories[category_name] = {}
+        for type_ in category.get("types") or ():
+            type_name = type_.get("name")
+            if not isinstance(type_name, str) or not type_name or type_name in types:
+                raise ValueError(f"{source}: type names must be unique within {category_name!r} ({type_name!r})")
+            questions = type_.get("questions")
+            if not questions or not all(isinstance(text, str) and text for text in questions):
+                raise ValueError(f"{source}: {category_name!r} / {type_name!r} needs a list of question texts")
+            for text in questions:
+                if text in seen_questions:
+                    raise ValueError(f"{source}: question {text!r} appears more than once")
+                seen_questions.add(text)
+            types[type_name] = list(questions)
+        if not types:
+            raise ValueError(f"{source}: category {category_name!r} has no types")
+    if not categories:
+        raise ValueError(f"{source}: no categories defined")
+    return categories
+
+
+# One question of the compiled index. Question ids are the column positions
+# used by the scoring engine and the widget keys in the app.
+class Question:
+    __slots__ = ("id", "category_id", "group_id", "category", "type", "text")
+
+    def __init__(self, id, category_id, group_id, category, type, text):
+        self.id = id
+        self.category_id = category_id
+        self.group_id = group_id
+        self.category = category
+        self.type = type
+        self.text = text
+
+    def __repr__(self):
+        return f"Question({self.id}, {self.category!r}, {self.type!r})"
+
+
+# Arrays of a QuestionnaireIndex, in the order they are stored in a compiled file
+_INDEX_ARRAYS = (
+    "group_offsets", "group_sizes", "group_category", "category_group_offsets",
+    "question_group", "question_category", "max_scores_per_group", "max_scores_per_category",
+)
+
+# Compiled file layout: magic, header length (little-endian uint64), JSON header,
+# then the raw arrays, each starting on a 64-byte boundary of the file
+_COMPILED_MAGIC = b"BIASQIX1"
+_ALIGNMENT = 64
+
+
+# Immutable, array-backed index of a questionnaire, built once per process.
+# Questions are numbered category by category and type by type, so every
+# (category, type) group and every category is a contiguous run of ids.
+# An index loaded from a compiled file keeps its arrays in a read-only memory
+# map, so every process serving that version shares one copy of them.
+class QuestionnaireIndex:
+    __slots__ = (
+        "key", "category_names", "groups", "questions", "question_texts",
+        "question_index", "question_columns", "num_questions",
+        "group_offsets", "group_sizes", "group_category", "category_group_offsets",
+        "question_group", "question_category",
+        "max_scores_per_group", "max_scores_per_category", "max_total_score",
+    )
+
+    def __init__(self, categories, key=None):
+        groups = []  # (category_name, type_name) in questionnaire order
+        question_texts = []
+        group_offsets = []
+        group_category = []
+        for category_id, (category_name, types) in enumerate(categories.items()):
+            for type_name, texts in types.items():
+                group_offsets.append(len(question_texts))
+                group_category.append(category_id)
+                groups.append((category_name, type_name))
+                question_texts.extend(texts)
+
+        group_offsets = np.array(group_offsets, dtype=np.intp)
+        group_category = np.array(group_category, dtype=np.intp)
+        group_sizes = np.diff(np.append(group_offsets, len(question_texts)))
+        question_group = np.repeat(np.arange(len(groups)), group_sizes)
+        # Offsets of the first group of each category within the group axis
+        category_group_offsets = np.searchsorted(group_category, np.arange(len(categories)))
+        max_scores_per_group = group_sizes * MAX_SCORE_PER_QUESTION
+        arrays = {
+            "group_offsets": group_offsets,
+            "group_sizes": group_sizes,
+            "group_category": group_category,
+            "category_group_offsets": category_group_offsets,
+            "question_group": question_group,
+            "question_category": group_category[question_group],
+            "max_scores_per_group": max_scores_per_group,
+            "max_scores_per_category": np.add.reduceat(max_scores_per_group, category_group_offsets),
+        }
+        self._set_up(key, list(categories), groups, question_texts, arrays)
+
+    def _set_up(self, key, category_names, groups, question_texts, arrays):
+        self.key = key
+        self.category_names = tuple(category_names)
+        self.groups = tuple(tuple(group) for group in groups)
+        self.question_texts = tuple(question_texts)
+        self.num_questions = len(question_texts)
+        for name in _INDEX_ARRAYS:
+            setattr(self, name, _frozen(arrays[name]))
+        self.max_total_score = int(self.max_scores_per_category.sum())
+
+        self.questions = tuple(
+            Question(
+                question_id, int(self.question_category[question_id]), int(group_id),
+                *self.groups[group_id], text
+            )
+            for question_id, (group_id, text) in enumerate(zip(self.question_group, self.question_texts))
+        )
+        self.question_index = {(q.category, q.type, q.text): q.id for q in self.questions}
+        self.question_columns = {q.text: q.id for q in self.questions}
+
+    def __len__(self):
+        return self.num_questions
+
+    # Function to rebuild the {category: {type: [questions]}} form of the index
+    def categories(self):
+        categories = {name: {} for name in self.category_names}
+        for q in self.questions:
+            categories[q.category].setdefault(q.type, []).append(q.text)
+        return categories
+
+    # Function to write the index as a compiled file, atomically
+    def save(self, path):
+        arrays = {name: np.ascontiguousarray(getattr(self, name), dtype="<i8") for name in _INDEX_ARRAYS}
+        header = {
+            "key": self.key,
+            "category_names": self.category_names,
+            "groups": self.groups,
+            "question_texts": self.question_texts,
+            "arrays": {},
+        }
+        # Array offsets are relative to the first aligned position after the header
+        position = 0
+        for name, array in arrays.items():
+            header["arrays"][name] = {"dtype": array.dtype.str, "shape": array.shape, "offset": position}
+            position = _aligned(position + array.nbytes)
+        header_bytes = json.dumps(header).encode()
+        data_start = _aligned(len(_COMPILED_MAGIC) + 8 + len(header_bytes))
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(_COMPILED_MAGIC + struct.pack("<Q", len(header_bytes)) + header_bytes)
+                for name, array in arrays.items():
+                    f.write(b"\0" * (data_start + header["arrays"][name]["offset"] - f.tell()))
+                    f.write(array.tobytes())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    # Function to load a compiled file, mapping its arrays instead of reading them
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            if f.read(len(_COMPILED_MAGIC)) != _COMPILED_MAGIC:
+                raise ValueError(f"{path!r} is not a compiled questionnaire")
+            (header_size,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_size))
+            data_start = _aligned(len(_COMPILED_MAGIC) + 8 + header_size)
+            # The map stays open for as long as any of its arrays is alive
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        arrays = {
+            name: np.frombuffer(
+                mapped, dtype=spec["dtype"], count=int(np.prod(spec["shape"])), offset=data_start + spec["offset"]
+            ).reshape(spec["shape"])
+            for name, spec in header["arrays"].items()
+        }
+        index = cls.__new__(cls)
+        index._set_up(header["key"], header["category_names"], header["groups"], header["question_texts"], arrays)
+        return index
+
+
+def _frozen(array):
+    if array.flags.writeable:
+        array.setflags(write=False)
+    return array
+
+
+def _aligned(position):
+    return -(-position // _ALIGNMENT) * _ALIGNMENT
+
+
+# Function to compile a definition file into an index file
+def compile_questionnaire(source, target, key=None):
+    index = QuestionnaireIndex(load_definition(source), key)
+    index.save(target)
+    return index
+
+
+# Every questionnaire version found in a definitions directory, compiled on first
+# use and cached per process. Compiled files are named after the definition's
+# content hash, so an edited definition is recompiled and processes still
+# serving the old content keep their own file.
+class QuestionnaireRegistry:
+    def __init__(self, directory=QUESTIONNAIRE_DIR, compiled_dir=COMPILED_DIR):
+        self.directory = directory
+        self.compiled_dir = compiled_dir
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    # Function to list the definition files as {"name@version": path}
+    def sources(self):
+        sources = {}
+        try:
+            file_names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return sources
+        for file_name in file_names:
+            match = _DEFINITION_FILE.match(file_name)
+            if match:
+                key = f"{match['name']}@{int(match['version'])}"
+                if key in sources:
+                    raise ValueError(f"More than one definition file for {key}")
+                sources[key] = os.path.join(self.directory, file_name)
+        return sources
+
+    def available(self):
+        return sorted(self.sources(), key=_version_order)
+
+    # Function to turn "name" into "name@<latest version>"; "name@version" is kept
+    def resolve(self, key):
+        sources = self.sources()
+        if "@" not in key:
+            versions = [k for k in sources if k.split("@")[0] == key]
+            if versions:
+                key = max(versions, key=_version_order)
+        if key not in sources:
+            raise ValueError(f"Unknown questionnaire {key!r}; available: {', '.join(self.available()) or 'none'}")
+        return key
+
+    # Function to get the compiled index of one questionnaire version
+    def get(self, key=DEFAULT_QUESTIONNAIRE):
+        key = self.resolve(key)
+        index = self._indexes.get(key)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(key)
+                if index is None:
+                    index = self._indexes[key] = self._load(key)
+        return index
+
+    def _load(self, key):
+        source = self.sources()[key]
+        with open(source, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        compiled = os.path.join(self.compiled_dir, f"{key}-{digest}.qidx")
+        if not os.path.exists(compiled):
+            try:
+                compile_questionnaire(source, compiled, key)
+            except OSError:
+                # Read-only deployment without a prebuilt file: keep a private copy
+                return QuestionnaireIndex(load_definition(source), key)
+        return QuestionnaireIndex.load(compiled)
+
+
+def _version_order(key):
+    name, version = key.split("@")
+    return name, int(version)
+
+
+# Definitions in the default questionnaire directory
+registry = QuestionnaireRegistry()
+
+# Compiled index of the default questionnaire, shared by every session in the process
+questionnaire_index = registry.get(DEFAULT_QUESTIONNAIRE)
+
+# The default questionnaire's categories, types, and questions
+categories = questionnaire_index.categories()
+
+# Flattened list of questions to display without headers
+questions_list = [
+    {"category": q.category, "type": q.type, "question": q.text}
+    for q in questionnaire_index.questions
+]
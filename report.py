@@ -0,0 +1,433 @@
+import importlib
+import os
+import threading
+from functools import lru_cache
+from io import BytesIO
+
+import metrics
+from cache import LRUCache
+
+# matplotlib, pandas and reportlab (and layout and pdfstream, which need reportlab)
+# are imported where they are first used, so importing this module is cheap and a
+# process pays for them only once it draws a chart or builds a PDF.
+
+# Path to the logo image, resolved next to this file so workers can run from any directory
+logo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Logo.png")
+
+# Resolution of the chart images embedded in the PDF, and of the charts shown on screen
+CHART_DPI = int(os.environ.get("BIAS_PRINT_DPI", 300))
+SCREEN_DPI = int(os.environ.get("BIAS_SCREEN_DPI", 100))
+
+# Reuse one figure per thread for every chart instead of building a figure per chart
+SHARED_FIGURE = os.environ.get("BIAS_SHARED_FIGURE", "1") == "1"
+
+# How charts are put in the PDF: "png" embeds matplotlib rasters at CHART_DPI,
+# "vector" draws the bars directly on the reportlab canvas
+CHART_MODES = ("png", "vector")
+CHART_MODE = os.environ.get("BIAS_CHART_MODE", "png")
+
+BAR_COLOR = "#377bff"
+
+# Page margin of the PDF, in points
+PAGE_MARGIN = 40
+
+# Caches for rendered chart PNGs and finished PDFs. Setting BIAS_CACHE_DIR adds an
+# on-disk tier that persists across restarts and is shared between processes.
+_cache_dir = os.environ.get("BIAS_CACHE_DIR")
+chart_cache = LRUCache(
+    max_entries=int(os.environ.get("BIAS_CHART_CACHE_SIZE", 256)),
+    disk_dir=os.path.join(_cache_dir, "charts") if _cache_dir else None,
+)
+pdf_cache = LRUCache(
+    max_entries=int(os.environ.get("BIAS_PDF_CACHE_SIZE", 64)),
+    disk_dir=os.path.join(_cache_dir, "pdfs") if _cache_dir else None,
+)
+metrics.watch_cache("chart", chart_cache)
+metrics.watch_cache("pdf", pdf_cache)
+
+
+# Function to build the Category / Type / Score / Percentage frame used for charts
+def scores_frame(flattened_scores):
+    import pandas as pd
+    scores_data = pd.DataFrame(flattened_scores)
+    # Sort the scores_data based on the ordered categories
+    ordered_categories = scores_data["Category"].unique()
+    scores_data["Category"] = pd.Categorical(
+        scores_data["Category"],
+        categories=ordered_categories,
+        ordered=True
+    )
+    return scores_data.sort_values(by=["Category", "Type"], ascending=[True, False])
+
+
+# Function to import matplotlib with the headless Agg backend, once per process
+@lru_cache(maxsize=None)
+def _figure_class():
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+    return Figure
+
+
+# Draws category charts on one Figure that is kept between charts: the parts
+# every chart shares are set up once, and each chart only updates the bar widths,
+# labels and title (the bars are rebuilt when the number of types changes).
+# Uses a standalone Figure rather than pyplot, and figures are not thread-safe,
+# so each thread has its own renderer (see chart_renderer).
+class ChartRenderer:
+    def __init__(self):
+        self.fig = _figure_class()(figsize=(10, 4))  # Increase the height for better readability
+        self.ax = self.fig.subplots()
+        self.ax.set_xlim(0, 100)
+        self.ax.set_xlabel('Percentage', fontsize=12)
+        self.ax.tick_params(axis='both', which='major', labelsize=10)
+        self.bars = None
+
+    # Function to draw one chart and return it as PNG bytes
+    def draw(self, category, types, percentages, dpi=CHART_DPI):
+        ax = self.ax
+        if self.bars is None or len(self.bars) != len(types):
+            if self.bars is not None:
+                self.bars.remove()
+            self.bars = ax.barh(range(len(types)), percentages, color=BAR_COLOR)
+            ax.set_yticks(range(len(types)))
+            ax.relim()
+            ax.autoscale_view()
+        else:
+            for bar, percentage in zip(self.bars, percentages):
+                bar.set_width(percentage)
+        ax.set_yticklabels(types)
+        ax.set_title(category, fontsize=14)
+        self.fig.tight_layout()
+
+        buf = BytesIO()
+        self.fig.savefig(buf, format='png', dpi=dpi)
+        return buf.getvalue()
+
+
+_renderers = threading.local()
+
+
+# Function to get this thread's shared chart renderer
+def chart_renderer():
+    renderer = getattr(_renderers, "renderer", None)
+    if renderer is None:
+        renderer = _renderers.renderer = ChartRenderer()
+    return renderer
+
+
+# Function to render one category's horizontal bar chart as PNG bytes
+def draw_category_chart(category, category_data, dpi=CHART_DPI):
+    renderer = chart_renderer() if SHARED_FIGURE else ChartRenderer()
+    return renderer.draw(category, category_data["Type"].tolist(), category_data["Percentage"].tolist(), dpi)
+
+
+# Function to get one category's chart as a PNG buffer, rendering it only on a cache miss.
+# The chart depends only on the category, its per-type percentages and the DPI.
+def render_category_chart(category, category_data, dpi=CHART_DPI):
+    category_data = category_data.sort_values(by=["Type"], ascending=[False])  # Ensure consistent order
+    key = (
+        "chart", category,
+        tuple(zip(category_data["Type"].tolist(), category_data["Percentage"].tolist())),
+        dpi,
+    )
+    def draw():
+        with metrics.span("draw_chart"):
+            return draw_category_chart(category, category_data, dpi)
+
+    png = chart_cache.get_or_create(key, draw)
+    metrics.record_bytes("chart", len(png))
+    return BytesIO(png)
+
+
+# Function to render the category charts one at a time, in category order
+def iter_category_charts(scores_data, dpi=CHART_DPI):
+    for category in scores_data["Category"].unique():
+        category_data = scores_data[scores_data["Category"] == category]
+        yield render_category_chart(category, category_data, dpi)
+
+
+# Function to render every category chart as PNG buffers, in category order
+def render_category_charts(scores_data, dpi=CHART_DPI):
+    return list(iter_category_charts(scores_data, dpi))
+
+
+# Function to load the logo once per process; returns None if it is unavailable
+@lru_cache(maxsize=None)
+def load_logo(path=logo_path):
+    from reportlab.lib.utils import ImageReader
+    try:
+        return ImageReader(path)
+    except Exception:
+        return None
+
+
+# Function to wrap text for the PDF
+def wrap_text(text, canvas, max_width, font_size):
+    from layout import wrap_words
+    return wrap_words(text, max_width, "Helvetica", font_size)
+
+
+# Explanations printed after the results, with bold headers
+EXPLANATIONS = (
+    ("How to interpret the results", "bold"),
+    ("The questions answered fall under the individual, company, and industry related actions and choices you make every day at work.", "normal"),
+    ("They address key areas from hiring through developing and retaining talent that we as company leaders make in relation to our peers, team members, superiors, and creating a broader impact on the industry.", "normal"),
+    ("Take a look at the scores below and see:", "normal"),
+    ("- Where do you score highest?", "normal"),
+    ("- Which area has the highest potential to improve?", "normal"),
+    ("- Is there anything that surprised you?", "normal"),
+    ("- What are some of the actions that you can take to reduce bias and drive inclusion?", "normal"),
+    ("", "normal"),  # Add a blank line for more space
+    ("Capture your reflection for a later conversation.", "normal"),
+    ("Development: Spans actions in the area of developing talent/your team", "bold_pre"),
+    ("General: Covers general work related attitudes and actions", "bold_pre"),
+    ("Recruiting & Hiring: Highlights potential bias in recruiting and hiring talent", "bold_pre"),
+    ("Performance & Reward: Looks at equity in relation to this area of rewarding the team", "bold_pre"),
+    ("Culture & Engagement: Your actions and attitudes related to organisational culture", "bold_pre"),
+    ("Exit & Retention: Actions related to retaining and understanding the reasons for talent drain", "bold_pre")
+)
+
+
+# Function to lay out the static explanations once per page width and font size.
+# Returns the steps for PageFlow.block(); the text never changes between reports.
+@lru_cache(maxsize=8)
+def layout_explanations(max_width, font_size):
+    from layout import wrap_words
+    steps = []
+    for explanation, style in EXPLANATIONS:
+        if style == "bold":
+            steps.append(("font", "Helvetica-Bold", font_size))
+            steps += [("line", line) for line in wrap_words(explanation, max_width, "Helvetica-Bold", font_size)]
+        elif style == "bold_pre":
+            text, remainder = explanation.split(":", 1)
+            steps.append(("font", "Helvetica-Bold", font_size))
+            steps += [("line", line) for line in wrap_words(text + ":", max_width, "Helvetica-Bold", font_size)]
+            steps.append(("font", "Helvetica", font_size))
+            steps += [("line", line) for line in wrap_words(remainder.strip(), max_width, "Helvetica", font_size)]
+        else:
+            steps.append(("font", "Helvetica", font_size))
+            steps += [("line", line) for line in wrap_words(explanation, max_width, "Helvetica", font_size)]
+        steps.append(("gap", 5))  # Add extra space between sections
+    return tuple(steps)
+
+
+# Function to draw one category's horizontal percentage bars as vector graphics,
+# laid out like the matplotlib chart inside the box (x, y, width, height)
+def draw_vector_chart(c, x, y, width, height, category, category_data):
+    from reportlab.lib import colors
+    category_data = category_data.sort_values(by=["Type"], ascending=[False])  # Ensure consistent order
+    types = category_data["Type"].tolist()
+    percentages = category_data["Percentage"].tolist()
+
+    # Plot area: room for the title above, tick labels and axis label below,
+    # and the longest type label on the left
+    label_width = max((c.stringWidth(t, "Helvetica", 10) for t in types), default=0)
+    left = x + label_width + 12
+    right = x + width - 10
+    bottom = y + 40
+    top = y + height - 30
+    plot_width = right - left
+    plot_height = top - bottom
+
+    c.saveState()
+    c.setFont("Helvetica", 14)
+    c.drawCentredString((left + right) / 2, top + 10, category)
+
+    # Bars, first type at the bottom as in matplotlib's barh
+    slot = plot_height / max(len(types), 1)
+    c.setFillColor(colors.HexColor(BAR_COLOR))
+    for i, percentage in enumerate(percentages):
+        bar_width = plot_width * min(max(percentage, 0), 100) / 100
+        if bar_width > 0:
+            c.rect(left, bottom + slot * (i + 0.1), bar_width, slot * 0.8, stroke=0, fill=1)
+
+    # Axes frame, ticks and labels
+    c.setFillColor(colors.black)
+    c.setStrokeColor(colors.black)
+    c.setLineWidth(0.8)
+    c.rect(left, bottom, plot_width, plot_height, stroke=1, fill=0)
+    c.setFont("Helvetica", 10)
+    for tick in range(0, 101, 20):
+        tick_x = left + plot_width * tick / 100
+        c.line(tick_x, bottom, tick_x, bottom - 4)
+        c.drawCentredString(tick_x, bottom - 14, str(tick))
+    for i, type_name in enumerate(types):
+        label_y = bottom + slot * (i + 0.5)
+        c.line(left, label_y, left - 4, label_y)
+        c.drawRightString(left - 6, label_y - 3.5, type_name)
+    c.setFont("Helvetica", 12)
+    c.drawCentredString((left + right) / 2, y + 8, "Percentage")
+    c.restoreState()
+
+
+# Function to draw the logo at the top of the flow. The canvas writes the logo
+# image into the document once and only references it on later pages.
+# on_logo_error is called with the exception if the logo cannot be drawn.
+def draw_logo(c, flow, on_logo_error=None):
+    try:
+        logo = load_logo()
+        if logo is None:
+            raise FileNotFoundError(logo_path)
+        logo_width, logo_height = logo.getSize()
+        aspect_ratio = logo_height / logo_width
+        logo_display_width = 60
+        logo_display_height = logo_display_width * aspect_ratio
+        c.drawImage(
+            logo, flow.margin, flow.y - logo_display_height,
+            width=logo_display_width, height=logo_display_height, reuse=True,  # Written once per document
+        )
+        flow.skip(logo_display_height + 20)
+    except Exception as e:
+        if on_logo_error is not None:
+            on_logo_error(e)
+
+
+# Function to draw one score line per category, as "score out of max (percent%)"
+def draw_category_scores(flow, total_scores_per_category, max_scores_per_category):
+    for category_name, score in total_scores_per_category.items():
+        max_score = max_scores_per_category[category_name]
+        progress = int((score / max_score) * 100)
+        flow.line(f"{category_name}: {score} out of {max_score} ({progress}%)", leading=15)
+
+
+# Function to draw the category charts two to a page, starting at height y of the
+# current page and continuing on as many pages as they need. The page holding the
+# last chart is left open. In "png" chart_mode chart_images may be any iterable of
+# PNG buffers (rendered from scores_data when None); each one is only read when its
+# chart is placed and is closed once it is in the PDF, and the canvas drops the
+# decoded pixels as soon as the image is written. In "vector" chart_mode the charts
+# are drawn from scores_data.
+def draw_charts(c, page_size, scores_data, chart_images=None, chart_mode="png", y=None):
+    width, height = page_size
+    margin = PAGE_MARGIN
+    top = height - 50
+    chart_height = 300
+    chart_spacing = 320  # Chart plus the gap below it; two fit on a page
+
+    # Charts are taken one at a time and drawn into a (x, y, width, height) box
+    if chart_mode == "vector":
+        charts = iter(scores_data["Category"].unique())
+
+        def draw_chart(category, x, y, w, h):
+            draw_vector_chart(c, x, y, w, h, category, scores_data[scores_data["Category"] == category])
+    else:
+        charts = iter(iter_category_charts(scores_data) if chart_images is None else chart_images)
+
+        def draw_chart(img, x, y, w, h):
+            img.seek(0)  # Ensure buffer is at the start before reading
+            # Passed as a buffer so the canvas matches it by content: a chart repeated
+            # within the document is written once
+            c.drawImage(img, x, y, width=w, height=h)
+            img.close()  # The image is written to the PDF, so release the buffer
+
+    y = top if y is None else y
+    for chart in charts:
+        if y - chart_spacing < margin:
+            c.showPage()
+            y = top
+        draw_chart(chart, margin, y - chart_height, width - 2 * margin, chart_height)
+        y -= chart_spacing
+
+
+# Function to generate PDF
+# Pages are written to output (a path or binary file object) as they are finished;
+# without one the PDF is returned in a BytesIO.
+# on_logo_error is called with the exception if the logo cannot be drawn.
+# chart_images, scores_data and chart_mode are used as in draw_charts.
+def generate_pdf(total_scores_per_category, max_scores_per_category, chart_images,
+                 output=None, on_logo_error=None, scores_data=None, chart_mode="png"):
+    if chart_mode not in CHART_MODES:
+        raise ValueError(f"Unknown chart mode {chart_mode!r}; use one of {', '.join(CHART_MODES)}")
+    from reportlab.lib.pagesizes import letter
+    from layout import PageFlow
+    from pdfstream import StreamingCanvas
+    buffer = BytesIO() if output is None else output
+    c = StreamingCanvas(buffer, pagesize=letter)
+    width, height = letter
+    margin = PAGE_MARGIN
+    flow = PageFlow(c, height, margin)
+
+    # Add the logo
+    draw_logo(c, flow, on_logo_error)
+
+    flow.set_font("Helvetica-Bold", 12)
+    flow.line("LEAD Network Anti-Bias Self Assessment Tool", leading=20)
+    flow.set_font("Helvetica", 10)
+    flow.line("Your results:", leading=15)
+    draw_category_scores(flow, total_scores_per_category, max_scores_per_category)
+
+    flow.skip(10)  # Extra space before explanations
+
+    # Add explanations with bold headers
+    flow.block(layout_explanations(width - 2 * margin, 10))
+
+    # Start a new page for the charts
+    c.showPage()
+    draw_charts(c, letter, scores_data, chart_images, chart_mode)
+
+    c.save()
+    if output is None:
+        buffer.seek(0)
+
+    return buffer
+
+
+# Function to get the full report PDF for one respondent, building it only on a cache miss.
+# The key is the full score vector; chart_images may be passed in when already rendered.
+def report_pdf(total_scores_per_category, max_scores_per_category, scores_data,
+               chart_images=None, on_logo_error=None, chart_mode=None):
+    chart_mode = chart_mode or CHART_MODE
+    key = (
+        "pdf",
+        tuple(total_scores_per_category.items()),
+        tuple(max_scores_per_category.items()),
+        # Percentage too: versions with the same names and scores can differ in their per-type maxima
+        tuple(scores_data[["Category", "Type", "Score", "Percentage"]].itertuples(index=False, name=None)),
+        chart_mode,
+        CHART_DPI if chart_mode == "png" else None,
+    )
+    pdf = pdf_cache.get(key)
+    if pdf is None:
+        logo_errors = []
+
+        def logo_error(e):
+            logo_errors.append(e)
+            if on_logo_error is not None:
+                on_logo_error(e)
+
+        with metrics.span("generate_pdf"):
+            pdf = generate_pdf(
+                total_scores_per_category, max_scores_per_category, chart_images,
+                on_logo_error=logo_error, scores_data=scores_data, chart_mode=chart_mode
+            ).getvalue()
+        metrics.record_bytes("pdf", len(pdf))
+        if not logo_errors:  # Do not keep a report that is missing its logo
+            pdf_cache.put(key, pdf)
+    return BytesIO(pdf)
+
+
+# Function to load everything charts and PDFs need ahead of the first request:
+# the libraries, the logo and the font width tables
+def warm_up():
+    from reportlab.lib.pagesizes import letter
+    # Imported only so later requests find them loaded
+    for module in ("pandas", "pdfstream"):
+        importlib.import_module(module)
+    _figure_class()
+    load_logo()
+    layout_explanations(letter[0] - 2 * PAGE_MARGIN, 10)
+
+
+_warm_up_started = False
+_warm_up_lock = threading.Lock()
+
+
+# Function to run warm_up in a background thread, at most once per process
+def start_warm_up():
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+    threading.Thread(target=warm_up, name="report-warm-up", daemon=True).start()
@@ -0,0 +1,193 @@
+import numpy as np
+
+from questionnaire import MAX_SCORE_PER_QUESTION, QuestionnaireIndex
+
+
+# Scoring engine that codes responses as an integer matrix (respondents x questions)
+# and computes every aggregate with grouped reductions over the index arrays
+# precomputed by QuestionnaireIndex. Accepts a categories dict or a compiled index.
+class ScoringEngine:
+    def __init__(self, categories):
+        if isinstance(categories, QuestionnaireIndex):
+            self.index = categories
+        else:
+            self.index = QuestionnaireIndex(categories)
+        for name in QuestionnaireIndex.__slots__:
+            setattr(self, name, getattr(self.index, name))
+        self._max_scores_by_category = {
+            name: int(score)
+            for name, score in zip(self.category_names, self.max_scores_per_category)
+        }
+
+    # Maximum possible score per category, keyed by category name
+    def max_scores_by_category(self):
+        return dict(self._max_scores_by_category)
+
+    # Encode one respondent's list of response dicts into a row of the score matrix.
+    # Unanswered questions (score None) are coded as 0 so they add nothing to any sum.
+    def encode(self, responses):
+        row = np.zeros(self.num_questions, dtype=np.int16)
+        for response in responses:
+            if response["score"] is None:
+                continue
+            column = self.question_index[(response["category"], response["type"], response["question"])]
+            row[column] = response["score"]
+        return row
+
+    # Encode columnar data keyed by question text (question -> sequence of scores)
+    # into a (rows x questions) matrix. Missing columns and empty or null cells count
+    # as unanswered; anything else must be an integer on the rating scale (1-5).
+    def encode_columns(self, columns, num_rows):
+        matrix = np.zeros((num_rows, self.num_questions), dtype=np.int16)
+        for question, values in columns.items():
+            column = self.question_columns.get(question)
+            if column is None:
+                raise ValueError(f"Unknown question column {question!r}")
+            scores = _fast_scores(values)
+            if scores is None:
+                scores = np.array([_parse_score(value) for value in values], dtype=np.int64)
+            elif ((scores < 1) | (scores > MAX_SCORE_PER_QUESTION)).any():
+                # Same rule as _parse_score: 0 is not a score, only blanks are unanswered
+                raise ValueError(f"Scores for {question!r} must be between 1 and {MAX_SCORE_PER_QUESTION}")
+            if len(scores) != num_rows:
+                raise ValueError(f"Column {question!r} has {len(scores)} rows, expected {num_rows}")
+            matrix[:, column] = scores
+        return matrix
+
+    # Encode many respondents at once into a (respondents x questions) matrix
+    def encode_batch(self, batch):
+        matrix = np.zeros((len(batch), self.num_questions), dtype=np.int16)
+        for i, responses in enumerate(batch):
+            matrix[i] = self.encode(responses)
+        return matrix
+
+    # Score a matrix of responses (or a single row) in one pass
+    def score(self, matrix):
+        matrix = np.atleast_2d(np.asarray(matrix, dtype=np.int64))
+        if matrix.shape[1] != self.num_questions:
+            raise ValueError(
+                f"Expected {self.num_questions} question columns, got {matrix.shape[1]}"
+            )
+        if matrix.shape[0] == 0:
+            per_group = np.zeros((0, len(self.groups)), dtype=np.int64)
+        else:
+            per_group = np.add.reduceat(matrix, self.group_offsets, axis=1)
+        return ScoreResult(self, per_group)
+
+
+# Convert a fully answered column of ints or digit strings without per-cell checks
+# (encode_columns checks the range afterwards).
+# Returns None when the column needs the slower cell-by-cell parse.
+def _fast_scores(values):
+    if isinstance(values, np.ndarray):
+        return values if values.dtype.kind in "iu" and values.ndim == 1 else None
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if isinstance(values[0], str):
+        try:
+            return np.fromiter(map(int, values), dtype=np.int64, count=len(values))
+        except (TypeError, ValueError):
+            return None
+    try:
+        scores = np.array(values)
+    except ValueError:  # Ragged nested sequences
+        return None
+    return scores if scores.dtype.kind in "iu" and scores.ndim == 1 else None
+
+
+# Parse one cell of a response file; blanks and nulls are unanswered (0)
+def _parse_score(value):
+    if value is None or value == "":
+        return 0
+    if isinstance(value, float):
+        if value != value:  # NaN from a null cell
+            return 0
+        if not value.is_integer():
+            raise ValueError(f"Score {value!r} is not a whole number")
+    if isinstance(value, bool):
+        raise ValueError(f"Score {value!r} is not a whole number")
+    try:
+        score = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Score {value!r} is not a whole number") from None
+    if not 1 <= score <= MAX_SCORE_PER_QUESTION:
+        raise ValueError(f"Score {value!r} must be between 1 and {MAX_SCORE_PER_QUESTION}")
+    return score
+
+
+# Function to calculate the maximum possible score per category
+def calculate_max_scores_per_category(categories):
+    return ScoringEngine(categories).max_scores_by_category()
+
+
+# Aggregated scores for a batch of respondents. Everything is derived from the
+# per-(category, type) sums, which are the only reduction over the raw matrix.
+class ScoreResult:
+    def __init__(self, engine, per_group):
+        self.engine = engine
+        self.per_group = per_group
+        if per_group.shape[0] == 0:
+            self.per_category = np.zeros((0, len(engine.category_names)), dtype=np.int64)
+        else:
+            self.per_category = np.add.reduceat(per_group, engine.category_group_offsets, axis=1)
+        self.totals = self.per_category.sum(axis=1)
+
+    def __len__(self):
+        return self.per_group.shape[0]
+
+    @property
+    def group_percentages(self):
+        return self.per_group / self.engine.max_scores_per_group * 100
+
+    @property
+    def category_percentages(self):
+        return self.per_category / self.engine.max_scores_per_category * 100
+
+    # Total score per category for one respondent, keyed by category name
+    def category_totals(self, i=0):
+        return {
+            name: int(score)
+            for name, score in zip(self.engine.category_names, self.per_category[i])
+        }
+
+    # Rows of Category / Type / Score / Percentage for one respondent
+    def type_rows(self, i=0):
+        percentages = self.group_percentages[i]
+        return [
+            {
+                "Category": category_name,
+                "Type": type_name,
+                "Score": int(self.per_group[i, g]),
+                "Percentage": float(percentages[g]),
+            }
+            for g, (category_name, type_name) in enumerate(self.engine.groups)
+        ]
+
+
+# One respondent's scores kept up to date while they answer. A change adds the
+# difference between the new and the old answer to its (category, type) sum, so
+# no update touches more than the questions that actually changed.
+class RunningScore:
+    def __init__(self, engine, answers):
+        self.engine = engine
+        self.answers = np.array(answers, dtype=np.int16)
+        self.per_group = engine.score(self.answers).per_group[0].copy()
+
+    # Function to record the answer to one question
+    def set_answer(self, question_id, score):
+        delta = int(score) - int(self.answers[question_id])
+        if delta:
+            self.per_group[self.engine.question_group[question_id]] += delta
+            self.answers[question_id] = score
+
+    # Function to record a full row of answers, applying only the changed ones
+    def update(self, answers):
+        answers = np.asarray(answers, dtype=np.int16)
+        changed = np.flatnonzero(answers != self.answers)
+        if changed.size:
+            delta = answers[changed].astype(np.int64) - self.answers[changed]
+            np.add.at(self.per_group, self.engine.question_group[changed], delta)
+            self.answers[changed] = answers[changed]
+
+    def result(self):
+        return ScoreResult(self.engine, self.per_group[None, :].copy())
@@ -0,0 +1,500 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from urllib.parse import parse_qs, urlsplit
+
+import batch
+import bulk_reports
+from questionnaire import DEFAULT_QUESTIONNAIRE, registry
+from scoring import ScoringEngine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+
+# Report jobs that may wait for a worker; submissions beyond this get a 503
+# (or a 413 when one request alone asks for more)
+DEFAULT_MAX_QUEUED = 256
+
+# Finished reports are kept this many seconds for clients to fetch
+JOB_TTL = 15 * 60
+
+# Limits on what one request may ask for
+MAX_BODY_BYTES = 16 * 2**20
+MAX_BATCH_SIZE = 10000
+MAX_WAIT = 60
+
+# Seconds a connection may take to send its request head
+HEADER_TIMEOUT = 30
+
+_REASONS = {
+    200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    408: "Request Timeout", 411: "Length Required", 413: "Payload Too Large",
+    431: "Request Header Fields Too Large", 500: "Internal Server Error", 503: "Service Unavailable",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+# A response as returned by ReportService.handle. Streaming responses carry an
+# async iterator of chunks instead of a body and are sent with chunked encoding.
+class Response:
+    __slots__ = ("status", "headers", "body", "chunks")
+
+    def __init__(self, status, body=b"", content_type="application/json", headers=None, chunks=None):
+        self.status = status
+        self.headers = {"Content-Type": content_type, **(headers or {})}
+        self.body = body
+        self.chunks = chunks
+
+    def json(self):
+        return json.loads(self.body)
+
+
+def json_response(status, data, headers=None):
+    return Response(status, json.dumps(data).encode(), headers=headers)
+
+
+# Function to get the scoring engine of a questionnaire version, once per process
+@lru_cache(maxsize=None)
+def engine_for(key):
+    return ScoringEngine(registry.get(key))
+
+
+# Function to encode submissions into an answers matrix. Each submission has
+# "answers", either a list of scores in question id order or an object keyed by
+# question text (missing questions are unanswered), and optionally "respondent_id".
+def encode_submissions(engine, submissions):
+    columns = {text: [None] * len(submissions) for text in engine.question_texts}
+    for i, submission in enumerate(submissions):
+        answers = submission.get("answers") if isinstance(submission, dict) else None
+        if isinstance(answers, list):
+            if len(answers) != engine.num_questions:
+                raise ValueError(f"Submission {i}: expected {engine.num_questions} answers, got {len(answers)}")
+            answers = dict(zip(engine.question_texts, answers))
+        elif not isinstance(answers, dict):
+            raise ValueError(f"Submission {i}: 'answers' must be a list or an object")
+        for question, score in answers.items():
+            column = columns.get(question)
+            if column is None:
+                raise ValueError(f"Submission {i}: unknown question {question!r}")
+            column[i] = score
+    return engine.encode_columns(columns, len(submissions))
+
+
+# Function to render one report in a worker process
+def _render(per_group, questionnaire_key, chart_mode):
+    return bulk_reports.render_report(per_group, engine_for(questionnaire_key), chart_mode)
+
+
+class Job:
+    __slots__ = ("id", "batch_id", "respondent_id", "questionnaire", "per_group", "status", "error",
+                 "report", "created_at", "finished_at", "done")
+
+    def __init__(self, batch_id, respondent_id, questionnaire, per_group):
+        self.id = uuid.uuid4().hex
+        self.batch_id = batch_id
+        self.respondent_id = respondent_id
+        self.questionnaire = questionnaire
+        self.per_group = per_group
+        self.status = "queued"
+        self.error = None
+        self.report = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.done = asyncio.Event()
+
+    def describe(self):
+        return {
+            "id": self.id,
+            "batch": self.batch_id,
+            "respondent_id": self.respondent_id,
+            "status": self.status,
+            "error": self.error,
+            "status_url": f"/jobs/{self.id}",
+            "report_url": f"/jobs/{self.id}/report",
+        }
+
+
+# Scoring and report service. Requests are handled on the event loop; scoring
+# runs in a thread and PDFs are rendered by a pool of worker processes fed from
+# a bounded queue, so rendering never blocks the loop and a full queue turns new
+# report submissions away with 503 instead of growing without limit.
+#
+# Routes:
+#   GET  /health                 queue and job counts
+#   GET  /questionnaires         available questionnaire versions
+#   POST /score                  score one submission ({"answers": ...}) or many ({"submissions": [...]})
+#   POST /reports                queue PDF reports for the same bodies; returns job handles
+#   GET  /jobs/<id>              job status
+#   GET  /jobs/<id>/report       the PDF once done (202 while pending; ?wait=<s> waits for it)
+#   GET  /batches/<id>           NDJSON stream with one line per job as it finishes
+class ReportService:
+    def __init__(self, workers=None, max_queued=DEFAULT_MAX_QUEUED, chart_mode=None, job_ttl=JOB_TTL,
+                 executor=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queued = max_queued
+        self.chart_mode = chart_mode
+        self.job_ttl = job_ttl
+        self.jobs = {}
+        self.batches = {}
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._queue = None
+        self._tasks = []
+
+    async def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=bulk_reports._init_worker)
+        self._queue = asyncio.Queue(self.max_queued)
+        # One dispatcher per worker keeps exactly as many jobs in the pool as it has workers
+        self._tasks = [asyncio.create_task(self._dispatch()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._expire_jobs()))
+        return self
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Workers
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            try:
+                job.report = await loop.run_in_executor(
+                    self._executor, _render, job.per_group, job.questionnaire, self.chart_mode
+                )
+                job.status = "done"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.status = "failed"
+                job.error = f"{type(e).__name__}: {e}"
+            job.per_group = None
+            job.finished_at = time.time()
+            job.done.set()
+
+    async def _expire_jobs(self):
+        while True:
+            await asyncio.sleep(min(self.job_ttl, 60))
+            cutoff = time.time() - self.job_ttl
+            for job_id in [job_id for job_id, job in self.jobs.items() if job.finished_at and job.finished_at < cutoff]:
+                job = self.jobs.pop(job_id)
+                batch_jobs = self.batches.get(job.batch_id)
+                if batch_jobs and all(self.jobs.get(other) is None for other in batch_jobs):
+                    del self.batches[job.batch_id]
+
+    # Requests
+
+    async def handle(self, method, target, body=b""):
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        parts = [part for part in url.path.split("/") if part]
+        try:
+            if parts == ["health"]:
+                self._allow(method, "GET")
+                return json_response(200, {
+                    "status": "ok", "queued": self._queue.qsize(), "jobs": len(self.jobs), "workers": self.workers,
+                })
+            if parts == ["questionnaires"]:
+                self._allow(method, "GET")
+                return json_response(200, {"questionnaires": registry.available(), "default": DEFAULT_QUESTIONNAIRE})
+            if parts == ["score"]:
+                self._allow(method, "POST")
+                return await self._score(body)
+            if parts == ["reports"]:
+                self._allow(method, "POST")
+                return await self._submit_reports(body)
+            if len(parts) == 2 and parts[0] == "jobs":
+                self._allow(method, "GET")
+                return json_response(200, self._job(parts[1]).describe())
+            if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "report":
+                self._allow(method, "GET")
+                return await self._report(self._job(parts[1]), query)
+            if len(parts) == 2 and parts[0] == "batches":
+                self._allow(method, "GET")
+                return self._stream_batch(parts[1])
+            raise HTTPError(404, f"No route for {url.path}")
+        except HTTPError as e:
+            return json_response(e.status, {"error": str(e)}, e.headers)
+        except Exception:
+            # Keep the connection usable and answer in JSON whatever went wrong
+            logger.exception("Error handling %s %s", method, target)
+            return json_response(500, {"error": "Internal server error"})
+
+    @staticmethod
+    def _allow(method, allowed):
+        if method != allowed:
+            raise HTTPError(405, f"Use {allowed}", {"Allow": allowed})
+
+    @staticmethod
+    def _json(body):
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            raise HTTPError(400, f"Invalid JSON: {e}") from e
+
+    def _job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPError(404, f"Unknown or expired job {job_id!r}")
+        return job
+
+    # Function to parse a score or report request body and score its submissions.
+    # CPU-bound, so callers run it in a thread rather than on the event loop.
+    def _scored(self, body, max_submissions=MAX_BATCH_SIZE):
+        data = self._json(body)
+        if not isinstance(data, dict):
+            raise HTTPError(400, "Expected a JSON object")
+        submissions = data["submissions"] if "submissions" in data else [data]
+        if not isinstance(submissions, list) or not submissions:
+            raise HTTPError(400, "'submissions' must be a non-empty list")
+        if len(submissions) > max_submissions:
+            raise HTTPError(413, f"At most {max_submissions} submissions per request")
+        questionnaire = data.get("questionnaire") or DEFAULT_QUESTIONNAIRE
+        if not isinstance(questionnaire, str):
+            raise HTTPError(400, "'questionnaire' must be a string")
+        try:
+            key = registry.resolve(questionnaire)
+            engine = engine_for(key)
+            result = engine.score(encode_submissions(engine, submissions))
+        except (ValueError, TypeError) as e:
+            raise HTTPError(400, str(e)) from e
+        ids = [
+            submission.get("respondent_id", i) if isinstance(submission, dict) else i
+            for i, submission in enumerate(submissions)
+        ]
+        return key, ids, result
+
+    async def _score(self, body):
+        def score():
+            key, ids, result = self._scored(body)
+            columns = batch.result_columns(result.engine)
+            return {"questionnaire": key, "results": [dict(zip(columns, row)) for row in batch.result_rows(ids, result)]}
+        return json_response(200, await asyncio.to_thread(score))
+
+    async def _submit_reports(self, body):
+        # A batch larger than the whole queue could never be accepted, so it gets a 413, not a 503
+        key, ids, result = await asyncio.to_thread(self._scored, body, min(MAX_BATCH_SIZE, self.max_queued))
+        # All of a request's jobs are queued or none are
+        if self.max_queued - self._queue.qsize() < len(ids):
+            raise HTTPError(503, "Report queue is full; try again later", {"Retry-After": "5"})
+        batch_id = uuid.uuid4().hex
+        jobs = [Job(batch_id, respondent_id, key, per_group) for respondent_id, per_group in zip(ids, result.per_group.tolist())]
+        for job in jobs:
+            self.jobs[job.id] = job
+            self._queue.put_nowait(job)
+        self.batches[batch_id] = [job.id for job in jobs]
+        return json_response(202, {
+            "batch": batch_id, "batch_url": f"/batches/{batch_id}", "jobs": [job.describe() for job in jobs],
+        })
+
+    async def _report(self, job, query):
+        wait = query.get("wait")
+        if wait and not job.done.is_set():
+            try:
+                timeout = min(float(wait[0]), MAX_WAIT)
+            except ValueError as e:
+                raise HTTPError(400, "'wait' must be a number of seconds") from e
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if job.status == "done":
+            return Response(200, job.report, "application/pdf", {
+                "Content-Disposition": f'attachment; filename="{bulk_reports.report_file_name(job.respondent_id, set())}"',
+            })
+        if job.status == "failed":
+            return json_response(500, job.describe())
+        return json_response(202, job.describe(), {"Retry-After": "1"})
+
+    def _stream_batch(self, batch_id):
+        job_ids = self.batches.get(batch_id)
+        if job_ids is None:
+            raise HTTPError(404, f"Unknown or expired batch {batch_id!r}")
+        jobs = [self.jobs[job_id] for job_id in job_ids if job_id in self.jobs]
+
+        async def events():
+            waiters = {asyncio.ensure_future(job.done.wait()): job for job in jobs}
+            try:
+                while waiters:
+                    finished, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                    for waiter in finished:
+                        yield json.dumps(waiters.pop(waiter).describe()).encode() + b"\n"
+            finally:
+                for waiter in waiters:
+                    waiter.cancel()
+
+        return Response(200, content_type="application/x-ndjson", chunks=events())
+
+    # HTTP/1.1 over asyncio streams
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        return await asyncio.start_server(self._connection, host, port, limit=64 * 1024)
+
+    async def _connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), HEADER_TIMEOUT)
+                except HTTPError as e:
+                    await self._write(writer, json_response(e.status, {"error": str(e)}), keep_alive=False)
+                    break
+                except asyncio.TimeoutError:
+                    break
+                if request is None:
+                    break
+                method, target, headers, keep_alive = request
+                body = await self._read_body(reader, headers)
+                if isinstance(body, Response):
+                    await self._write(writer, body, keep_alive=False)
+                    break
+                response = await self.handle(method, target, body)
+                await self._write(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    @staticmethod
+    async def _read_request(reader):
+        try:
+            line = await reader.readline()
+        except ValueError as e:
+            raise HTTPError(400, "Request line too long") from e
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError as e:
+            raise HTTPError(400, "Malformed request line") from e
+        headers = {}
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError as e:
+                raise HTTPError(431, "Header line too long") from e
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        return method, target, headers, keep_alive
+
+    @staticmethod
+    async def _read_body(reader, headers):
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            return json_response(411, {"error": "Send a Content-Length instead of a chunked body"})
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            return json_response(400, {"error": "Invalid Content-Length"})
+        if length > MAX_BODY_BYTES:
+            return json_response(413, {"error": f"Bodies are limited to {MAX_BODY_BYTES} bytes"})
+        return await reader.readexactly(length) if length else b""
+
+    @staticmethod
+    async def _write(writer, response, keep_alive):
+        head = [f"HTTP/1.1 {response.status} {_REASONS.get(response.status, '')}"]
+        head += [f"{name}: {value}" for name, value in response.headers.items()]
+        head.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        if response.chunks is None:
+            head.append(f"Content-Length: {len(response.body)}")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + response.body)
+            await writer.drain()
+            return
+        head.append("Transfer-Encoding: chunked")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        async for chunk in response.chunks:
+            writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+# Client that calls a ReportService in the same process without a socket, for
+# tests and scripts. Responses are the service's own Response objects.
+class LocalClient:
+    def __init__(self, service):
+        self.service = service
+
+    async def request(self, method, path, data=None):
+        body = b"" if data is None else json.dumps(data).encode()
+        return await self.service.handle(method, path, body)
+
+    async def get(self, path):
+        return await self.request("GET", path)
+
+    async def post(self, path, data):
+        return await self.request("POST", path, data)
+
+    # Function to read a streaming response (such as /batches/<id>) as a list of JSON lines
+    async def stream(self, path):
+        response = await self.get(path)
+        if response.chunks is None:
+            return response, []
+        return response, [json.loads(line) async for chunk in response.chunks for line in chunk.splitlines()]
+
+
+async def _serve_forever(args):
+    async with ReportService(args.workers, args.max_queued, args.chart_mode) as service:
+        server = await service.serve(args.host, args.port)
+        addresses = ", ".join(f"{sock.getsockname()[0]}:{sock.getsockname()[1]}" for sock in server.sockets)
+        print(f"Serving on {addresses} with {service.workers} report workers", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve scoring and PDF reports over HTTP.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=None, help="Report worker processes (default: CPU count)")
+    parser.add_argument("--max-queued", type=int, default=DEFAULT_MAX_QUEUED,
+                        help="Report jobs that may wait for a worker before new ones are refused")
+    parser.add_argument("--chart-mode", choices=("png", "vector"), default=None,
+                        help="Embed charts as PNG images or draw them as vector graphics")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(_serve_forever(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
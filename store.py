@@ -0,0 +1,450 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Writes are grouped into batches of at most this many records...
+BATCH_SIZE = 500
+# ...or flushed after this many seconds, whichever comes first
+FLUSH_INTERVAL = 1.0
+
+
+# Scored assessment as queued for storage; category rows are derived from the ScoreResult.
+# The questionnaire version ("name@version") is kept with it, since the answers are
+# indexed by question id and only make sense against the version that produced them.
+class AssessmentRecord:
+    __slots__ = ("created_at", "questionnaire", "cohort", "respondent_id", "total", "answers", "categories")
+
+    def __init__(self, answers, result, cohort=None, respondent_id=None, created_at=None):
+        engine = result.engine
+        self.created_at = time.time() if created_at is None else created_at
+        self.questionnaire = engine.index.key
+        self.cohort = cohort
+        self.respondent_id = respondent_id
+        self.total = int(result.totals[0])
+        self.answers = np.asarray(answers, dtype=np.int8).tobytes()
+        self.categories = [
+            (name, int(result.per_category[0, c]), int(engine.max_scores_per_category[c]))
+            for c, name in enumerate(engine.category_names)
+        ]
+
+
+# Interface for result stores. record_assessment and record_visit only queue the
+# record; a background thread writes queued records in batches, so the request
+# path never waits on I/O. Subclasses implement _write_batch and the queries.
+class ResultStore:
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._pending_visits = 0
+        self._pending_lock = threading.Lock()
+        self._closed = False
+        self._writer = threading.Thread(target=self._run_writer, name="result-store-writer", daemon=True)
+        self._writer.start()
+
+    # Function to queue one scored assessment (answers row and its ScoreResult)
+    def record_assessment(self, answers, result, cohort=None, respondent_id=None, created_at=None):
+        self._queue.put(AssessmentRecord(answers, result, cohort, respondent_id, created_at))
+
+    # Function to queue one page visit
+    def record_visit(self, session_id=None, created_at=None):
+        with self._pending_lock:
+            self._pending_visits += 1
+        self._queue.put(("visit", time.time() if created_at is None else created_at, session_id))
+
+    # Total visits across every process sharing the store, including this
+    # process's visits that are still waiting to be written
+    def visit_count(self):
+        with self._pending_lock:
+            pending = self._pending_visits
+        return self._stored_visit_count() + pending
+
+    # Function to block until everything queued so far has been written
+    def flush(self):
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run_writer(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            assessments, visits, waiters = [], [], []
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                elif isinstance(item, AssessmentRecord):
+                    assessments.append(item)
+                else:
+                    visits.append(item)
+                if stop or waiters or len(assessments) + len(visits) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if assessments or visits:
+                try:
+                    self._write_batch(assessments, visits)
+                except Exception:
+                    # Keep the writer alive; a failed batch must not take the app down
+                    logger.exception("Could not write %d results to the store", len(assessments) + len(visits))
+                finally:
+                    with self._pending_lock:
+                        self._pending_visits -= len(visits)
+            for waiter in waiters:
+                waiter.set()
+        self._close_backend()
+
+    def _write_batch(self, assessments, visits):
+        raise NotImplementedError
+
+    def _stored_visit_count(self):
+        raise NotImplementedError
+
+    def _close_backend(self):
+        pass
+
+    # Category scores between two timestamps, optionally for one questionnaire
+    # version, cohort and/or category, as dicts with created_at, questionnaire,
+    # cohort, respondent_id, category, score, max_score and percentage
+    def query_category_scores(self, start=None, end=None, cohort=None, category=None, questionnaire=None):
+        raise NotImplementedError
+
+
+# SQLite backend. Safe to share between processes: WAL mode lets readers run
+# alongside the single writer, and the visit counter is updated atomically.
+class SQLiteStore(ResultStore):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS assessments (
+            id INTEGER PRIMARY KEY,
+            created_at REAL NOT NULL,
+            questionnaire TEXT,
+            cohort TEXT,
+            respondent_id TEXT,
+            total INTEGER NOT NULL,
+            answers BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS category_scores (
+            assessment_id INTEGER NOT NULL REFERENCES assessments(id),
+            created_at REAL NOT NULL,
+            questionnaire TEXT,
+            cohort TEXT,
+            category TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            max_score INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS visits (
+            created_at REAL NOT NULL,
+            session_id TEXT
+        );
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS assessments_created_at ON assessments (created_at);
+        CREATE INDEX IF NOT EXISTS assessments_cohort ON assessments (cohort, created_at);
+        CREATE INDEX IF NOT EXISTS category_scores_category ON category_scores (category, created_at);
+        CREATE INDEX IF NOT EXISTS category_scores_cohort ON category_scores (cohort, created_at);
+        CREATE INDEX IF NOT EXISTS visits_created_at ON visits (created_at);
+    """
+
+    # Columns added after the first release, with their types, for existing databases
+    ADDED_COLUMNS = {
+        "assessments": (("questionnaire", "TEXT"),),
+        "category_scores": (("questionnaire", "TEXT"),),
+    }
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        connection = self._connect()
+        connection.executescript(self.SCHEMA)
+        with connection:
+            for table, columns in self.ADDED_COLUMNS.items():
+                existing = {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+                for name, column_type in columns:
+                    if name not in existing:
+                        connection.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+        connection.close()
+        self._writer_connection = None  # Opened by the writer thread
+        self._reader = self._connect()
+        self._reader_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _write_batch(self, assessments, visits):
+        if self._writer_connection is None:
+            self._writer_connection = self._connect()
+        connection = self._writer_connection
+        with connection:
+            for record in assessments:
+                cursor = connection.execute(
+                    "INSERT INTO assessments (created_at, questionnaire, cohort, respondent_id, total, answers) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (record.created_at, record.questionnaire, record.cohort, record.respondent_id,
+                     record.total, record.answers),
+                )
+                connection.executemany(
+                    "INSERT INTO category_scores "
+                    "(assessment_id, created_at, questionnaire, cohort, category, score, max_score) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (cursor.lastrowid, record.created_at, record.questionnaire, record.cohort,
+                         name, score, max_score)
+                        for name, score, max_score in record.categories
+                    ],
+                )
+            if visits:
+                connection.executemany(
+                    "INSERT INTO visits (created_at, session_id) VALUES (?, ?)",
+                    [(created_at, session_id) for _, created_at, session_id in visits],
+                )
+                connection.execute(
+                    "INSERT INTO counters (name, value) VALUES ('visits', ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    (len(visits),),
+                )
+
+    def _stored_visit_count(self):
+        with self._reader_lock:
+            row = self._reader.execute("SELECT value FROM counters WHERE name = 'visits'").fetchone()
+        return row[0] if row else 0
+
+    def _close_backend(self):
+        if self._writer_connection is not None:
+            self._writer_connection.close()
+        with self._reader_lock:
+            self._reader.close()
+
+    def query_category_scores(self, start=None, end=None, cohort=None, category=None, questionnaire=None):
+        conditions, parameters = [], []
+        for clause, value in (
+            ("s.created_at >= ?", start),
+            ("s.created_at < ?", end),
+            ("s.questionnaire = ?", questionnaire),
+            ("s.cohort = ?", cohort),
+            ("s.category = ?", category),
+        ):
+            if value is not None:
+                conditions.append(clause)
+                parameters.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._reader_lock:
+            rows = self._reader.execute(
+                "SELECT s.created_at, s.questionnaire, s.cohort, a.respondent_id, s.category, s.score, s.max_score "
+                f"FROM category_scores s JOIN assessments a ON a.id = s.assessment_id {where} "
+                "ORDER BY s.created_at",
+                parameters,
+            ).fetchall()
+        return [
+            {
+                "created_at": created_at, "questionnaire": questionnaire, "cohort": cohort,
+                "respondent_id": respondent_id, "category": name, "score": score, "max_score": max_score,
+                "percentage": score / max_score * 100,
+            }
+            for created_at, questionnaire, cohort, respondent_id, name, score, max_score in rows
+        ]
+
+
+# Columnar backend writing one Parquet file per batch and dataset (assessments,
+# category_scores, visits), partitioned by day so time-range queries only open the
+# matching partitions. Each process writes its own uniquely named files, so several
+# processes can share one directory.
+class ParquetStore(ResultStore):
+    def __init__(self, directory, **kwargs):
+        try:
+            import pyarrow
+            import pyarrow.dataset
+            import pyarrow.parquet
+        except ImportError as e:
+            raise RuntimeError("The Parquet result store requires the 'pyarrow' package") from e
+        self.pyarrow = pyarrow
+        self.directory = directory
+        # Explicit schemas, so a batch where every cohort (or id) is None is still
+        # written as strings rather than as a null column that later files cannot match
+        pa = pyarrow
+        self._schemas = {
+            "assessments": pa.schema([
+                ("id", pa.string()),
+                ("created_at", pa.float64()),
+                ("questionnaire", pa.string()),
+                ("cohort", pa.string()),
+                ("respondent_id", pa.string()),
+                ("total", pa.int64()),
+                ("answers", pa.binary()),
+            ]),
+            "category_scores": pa.schema([
+                ("assessment_id", pa.string()),
+                ("created_at", pa.float64()),
+                ("questionnaire", pa.string()),
+                ("cohort", pa.string()),
+                ("respondent_id", pa.string()),
+                ("category", pa.string()),
+                ("score", pa.int64()),
+                ("max_score", pa.int64()),
+            ]),
+            "visits": pa.schema([
+                ("created_at", pa.float64()),
+                ("session_id", pa.string()),
+            ]),
+        }
+        self._day_partitioning = pa.dataset.partitioning(pa.schema([("day", pa.string())]), flavor="hive")
+        # Row counts of the visit files already counted, by path. Files are never
+        # changed once written, so each one only has to be opened once.
+        self._visit_file_rows = {}
+        for kind in self._schemas:
+            os.makedirs(os.path.join(directory, kind), exist_ok=True)
+        super().__init__(**kwargs)
+
+    def _write_table(self, kind, columns, created_at):
+        pa = self.pyarrow
+        table = pa.table(columns, schema=self._schemas[kind])
+        partition = os.path.join(self.directory, kind, f"day={_day(min(created_at))}")
+        os.makedirs(partition, exist_ok=True)
+        name = f"part-{uuid.uuid4().hex}.parquet"
+        # Write under a hidden name first so readers never see half-written files
+        pa.parquet.write_table(table, os.path.join(partition, "." + name))
+        os.replace(os.path.join(partition, "." + name), os.path.join(partition, name))
+
+    def _write_batch(self, assessments, visits):
+        # Group rows by day so each file lands in its partition
+        by_day = {}
+        for record in assessments:
+            by_day.setdefault(_day(record.created_at), []).append(record)
+        for records in by_day.values():
+            # Assessments get random ids, since several processes may write to one directory
+            ids = [uuid.uuid4().hex for _ in records]
+            created_at = [record.created_at for record in records]
+            self._write_table("assessments", {
+                "id": ids,
+                "created_at": created_at,
+                "questionnaire": [record.questionnaire for record in records],
+                "cohort": [record.cohort for record in records],
+                "respondent_id": [None if record.respondent_id is None else str(record.respondent_id) for record in records],
+                "total": [record.total for record in records],
+                "answers": [record.answers for record in records],
+            }, created_at)
+
+            rows = [
+                (assessment_id, record.created_at, record.questionnaire, record.cohort, record.respondent_id,
+                 name, score, max_score)
+                for assessment_id, record in zip(ids, records)
+                for name, score, max_score in record.categories
+            ]
+            # Sort by category and cohort so row-group statistics can skip data
+            rows.sort(key=lambda row: (row[5], row[3] or "", row[1]))
+            assessment_id, created_at, questionnaire, cohort, respondent_id, category, score, max_score = zip(*rows)
+            self._write_table("category_scores", {
+                "assessment_id": list(assessment_id),
+                "created_at": list(created_at),
+                "questionnaire": list(questionnaire),
+                "cohort": list(cohort),
+                "respondent_id": [None if r is None else str(r) for r in respondent_id],
+                "category": list(category),
+                "score": list(score),
+                "max_score": list(max_score),
+            }, created_at)
+        if visits:
+            created_at = [created_at for _, created_at, _ in visits]
+            self._write_table("visits", {
+                "created_at": created_at,
+                "session_id": [session_id for _, _, session_id in visits],
+            }, created_at)
+
+    def _dataset(self, kind):
+        pa = self.pyarrow
+        # Reading with the full schema also copes with older files: all-None columns
+        # stored as nulls, and columns added since (such as questionnaire) read as None
+        schema = pa.unify_schemas([self._schemas[kind], self._day_partitioning.schema])
+        return pa.dataset.dataset(
+            os.path.join(self.directory, kind), format="parquet",
+            partitioning=self._day_partitioning, schema=schema,
+        )
+
+    # Counted from the Parquet footers of new files only: the app calls this on
+    # every rerun, and scanning the whole visits dataset each time grows with traffic
+    def _stored_visit_count(self):
+        visits_dir = os.path.join(self.directory, "visits")
+        total = 0
+        for partition in os.scandir(visits_dir):
+            if not partition.is_dir():
+                continue
+            for entry in os.scandir(partition.path):
+                if entry.name.startswith(".") or not entry.name.endswith(".parquet"):
+                    continue
+                rows = self._visit_file_rows.get(entry.path)
+                if rows is None:
+                    rows = self._visit_file_rows[entry.path] = self.pyarrow.parquet.ParquetFile(entry.path).metadata.num_rows
+                total += rows
+        return total
+
+    def query_category_scores(self, start=None, end=None, cohort=None, category=None, questionnaire=None):
+        ds = self.pyarrow.dataset
+        expression = None
+        for condition in (
+            # Day partitions prune whole directories before row filters run
+            None if start is None else ds.field("day") >= _day(start),
+            None if end is None else ds.field("day") <= _day(end),
+            None if start is None else ds.field("created_at") >= start,
+            None if end is None else ds.field("created_at") < end,
+            None if questionnaire is None else ds.field("questionnaire") == questionnaire,
+            None if cohort is None else ds.field("cohort") == cohort,
+            None if category is None else ds.field("category") == category,
+        ):
+            if condition is not None:
+                expression = condition if expression is None else expression & condition
+        table = self._dataset("category_scores").to_table(
+            columns=["created_at", "questionnaire", "cohort", "respondent_id", "category", "score", "max_score"],
+            filter=expression,
+        )
+        rows = sorted(table.to_pylist(), key=lambda row: row["created_at"])
+        for row in rows:
+            row["percentage"] = row["score"] / row["max_score"] * 100
+        return rows
+
+
+# Function to name the UTC day partition of a timestamp
+def _day(timestamp):
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+
+# Function to open a store from a URL. As with SQLAlchemy URLs, three slashes give a
+# relative path and four an absolute one: sqlite:///results.db, parquet:////data/results
+def open_store(url, **kwargs):
+    scheme, _, path = url.partition("://")
+    if path.startswith("/"):
+        path = path[1:]
+    if scheme == "sqlite":
+        return SQLiteStore(path, **kwargs)
+    if scheme == "parquet":
+        return ParquetStore(path, **kwargs)
+    raise ValueError(f"Unknown result store {url!r}; use sqlite:///path or parquet:///path")